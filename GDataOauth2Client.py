@@ -12,6 +12,7 @@ Classes Contained:
 OAuth2DeviceClient - The main OAuth 2.0 client
 OAuth2DeviceClient.MessageTypes - Messages that the OAuth2DeviceClient can send.
 OAuth2Deviceclient.GDataAuthError - Error types that this application can return.
+TokenState - States that an OAuth2Token's access token can be in.
 OAuth2Token - A serializable class representing a generic Google OAuth2 Token
 
 Dependencies:
@@ -19,11 +20,30 @@ pycurl
 """
 
 from enum import Enum
-from io import BytesIO
 import pycurl
-from urllib.parse import urlencode
+from urllib.parse import urlencode, quote_plus
 import json
 import time
+import threading
+
+#Share handle used by every curl handle in the Google Data clients so they can reuse each other's
+#DNS lookups and TLS sessions instead of repeating them when a new connection is opened.
+curlShare = pycurl.CurlShare()
+curlShare.setopt(pycurl.SH_SHARE, pycurl.LOCK_DATA_DNS)
+curlShare.setopt(pycurl.SH_SHARE, pycurl.LOCK_DATA_SSL_SESSION)
+
+def newCurlHandle():
+    """Create a curl handle set up for talking to the Google Data APIs.
+    HTTP/2 is used if libcurl supports it, and TCP keepalive stops idle connections from being dropped between sessions."""
+    curl = pycurl.Curl()
+    curl.setopt(pycurl.SHARE, curlShare)
+    #Older pycurl builds on Raspbian don't have the HTTP/2 constants, and they just keep using HTTP/1.1
+    http2Feature = getattr(pycurl, "VERSION_HTTP2", None)
+    http2Version = getattr(pycurl, "CURL_HTTP_VERSION_2TLS", None)
+    if((http2Feature is not None) and (http2Version is not None) and (pycurl.version_info()[4] & http2Feature)):
+        curl.setopt(pycurl.HTTP_VERSION, http2Version)
+    curl.setopt(pycurl.TCP_KEEPALIVE, 1)
+    return curl
 
 #######################################################################
 # MessageTypes                                                        #
@@ -49,6 +69,18 @@ class GDataOAuthError(Enum):
     ERR_CREDENTIALS = 3
     ERR_AUTH_FAILED = 4
 
+########################################################################
+# TokenState                                                           #
+########################################################################
+class TokenState(Enum):
+    """States an OAuth2Token's access token can be in."""
+    #The access token is valid and not close to expiring
+    STATE_FRESH = 0
+    #The access token is missing, expired or about to expire
+    STATE_STALE = 1
+    #Another thread is currently refreshing the access token
+    STATE_REFRESHING = 2
+
 
 ############################################################################
 # OAuth2DeviceClient                                                       #
@@ -114,7 +146,7 @@ Message Type definitions:
          <GDataOauth2Client.OAuth2Token object at 0x76a3d230>
 
 Error Types:
-   ERR_UNKNOWN = 0 - Thrown for Errors that have not otherwise been identified
+   ERR_UNKNOWN = 0 - Thrown for Errors that have not otherwise been identified, including responses that can't be parsed
    ERR_NETWORK = 1 - Thrown for network errors that prevent pycurl from contacting the server
    ERR_PROTOCOL = 2 - Thrown for protocol errors that prevent successful communication
    ERR_CREDENTIALS = 3 - Thrown if there is something wrong with the provided client ID or secret
@@ -122,6 +154,16 @@ Error Types:
 
 """
 
+    #Error reported to the application for each unsuccessful HTTP response code. Anything else is ERR_UNKNOWN.
+    responseErrors = { 400: GDataOAuthError.ERR_PROTOCOL,
+                       401: GDataOAuthError.ERR_CREDENTIALS,
+                       403: GDataOAuthError.ERR_AUTH_FAILED }
+
+    #Fields that must be present in successful responses
+    deviceCodeFields = ('device_code', 'user_code', 'verification_url', 'expires_in')
+    refreshFields = ('access_token', 'token_type', 'expires_in')
+    tokenFields = refreshFields + ('refresh_token',)
+
     #----------------------------------------------------------------------#
     def __init__(self, clientId, clientSecret, scopeList, applicationCallback):
         """Initialize the device client
@@ -141,59 +183,125 @@ Error Types:
         self.scopeList = scopeList
         self.applicationCallback = applicationCallback
         self.deviceCode = ""
-        self.pollInterval = 10
+        #RFC 8628 polling interval to use if the server does not provide one
+        self.defaultPollInterval = 5
+        self.interval = self.defaultPollInterval
+        self.deviceCodeExpiration = 0
+
+        #The client credentials and grant types never change, so their part of the POST bodies is encoded once.
+        self.__pollFieldsPrefix = urlencode({ 'client_id': self.clientId, 'client_secret': self.clientSecret, 'grant_type': self.grantType })
+        self.__refreshFieldsPrefix = urlencode({ 'client_id': self.clientId, 'client_secret': self.clientSecret, 'grant_type': self.refreshGrantType })
+
+        #A single curl handle is reused for every request so libcurl can keep the connection to google alive.
+        #The OAuth responses are small, so a request that takes longer than the timeout has stalled.
+        self.requestTimeout = 30
+        self.__curl = newCurlHandle()
+        self.__curl.setopt(pycurl.CONNECTTIMEOUT, self.requestTimeout)
+        self.__curl.setopt(pycurl.TIMEOUT, self.requestTimeout)
+        self.__curlLock = threading.Lock()
+        #The URL and POST body last set on the handle. The poll loop sends the same request repeatedly, so these are only set when they change.
+        self.__curlUrl = None
+        self.__curlPostFields = None
+
+        #Set to stop polling for authorization
+        self.__cancelEvent = threading.Event()
+
+    #---------------------------------------------------------------------#
+    def cancel(self):
+        """Stop waiting for the user to grant permission. The polling thread stops immediately and the
+        application callback receives MSG_OAUTH_FAILED with ERR_AUTH_FAILED."""
+        self.__cancelEvent.set()
+
+    #---------------------------------------------------------------------#
+    def close(self):
+        """Release the curl handle and any connections it is holding open."""
+        self.__curl.close()
+
+    #---------------------------------------------------------------------#
+    def __performPost(self, url, postFields):
+        """Send a POST request using the shared curl handle.
+        Returns a (responseCode, body) tuple. Raises pycurl.error if the request could not be sent."""
+        #The body is collected into a bytearray and decoded once the whole response has arrived
+        body = bytearray()
+        with self.__curlLock:
+            if(url != self.__curlUrl):
+                self.__curl.setopt(pycurl.URL, url)
+                self.__curlUrl = url
+            if(postFields != self.__curlPostFields):
+                self.__curl.setopt(pycurl.POSTFIELDS, postFields)
+                self.__curlPostFields = postFields
+            self.__curl.setopt(pycurl.WRITEFUNCTION, body.extend)
+            self.__curl.perform()
+            responseCode = self.__curl.getinfo(pycurl.RESPONSE_CODE)
+        return (responseCode, body)
+
+    #---------------------------------------------------------------------#
+    def __postForJSON(self, url, postFields, requiredFields):
+        """Send a POST request and decode the JSON response. Returns a (responseCode, response dictionary) tuple.
+        Raises pycurl.error if the request could not be sent and ValueError if the response is not valid JSON,
+        is missing requiredFields on success, or is missing the error field on failure."""
+        responsecode, body = self.__performPost(url, postFields)
+        #json.loads only accepts str on python 3.5. A body that isn't valid utf-8 raises UnicodeDecodeError, which is a ValueError.
+        reqResp = json.loads(body.decode('utf-8'))
+        if(not isinstance(reqResp, dict)):
+            raise ValueError("Expected a JSON object")
+
+        if(responsecode == 200):
+            missingFields = [ field for field in requiredFields if field not in reqResp ]
+        else:
+            missingFields = [ field for field in ('error',) if field not in reqResp ]
+        if(len(missingFields) > 0):
+            raise ValueError("Response " + str(responsecode) + " is missing " + ", ".join(missingFields))
+        
+        return (responsecode, reqResp)
+
+    #---------------------------------------------------------------------#
+    def __invalidResponseMessage(self, err):
+        """Build the MSG_OAUTH_FAILED data for a response that could not be understood.
+        These are usually transient, like an HTML error page from a proxy, so they are not reported as ERR_PROTOCOL,
+        which tells the application that its token or request was rejected."""
+        return { 'error_code': GDataOAuthError.ERR_UNKNOWN, 'error_string': "Invalid response: " + str(err) }
+
+    #---------------------------------------------------------------------#
+    def __failureMessage(self, responsecode, reqResp):
+        """Build the MSG_OAUTH_FAILED data for an unsuccessful response from the OAuth servers."""
+        errorString = reqResp['error']
+        if('error_description' in reqResp):
+            errorString += ": " + reqResp['error_description']
+        return { 'error_code': self.responseErrors.get(responsecode, GDataOAuthError.ERR_UNKNOWN), 'error_string': errorString }
 
     #---------------------------------------------------------------------#
     def requestAuthorization(self):
+        self.__cancelEvent.clear()
 
         #Set up scope string
-        scopeString = self.scopeList[0]
-        for i in range(1, len(self.scopeList)):
-            scopeString += " " + self.scopeList[i]
+        scopeString = " ".join(self.scopeList)
 
         #Create post data
         postData = {'client_id': self.clientId, 'scope': scopeString } 
         postFields = urlencode(postData)
         try:
-            #Call curl here
-            buffer = BytesIO()
-            c = pycurl.Curl()
-            c.setopt(c.URL, self.authServer)
-            c.setopt(c.POSTFIELDS, postFields)
-            c.setopt(c.WRITEDATA, buffer)
-            c.perform()
-
-            body = buffer.getvalue()
-
-            responsecode = c.getinfo(c.RESPONSE_CODE)
-            reqResp = json.loads(body.decode('iso-8859-1'))
-
+            responsecode, reqResp = self.__postForJSON(self.authServer, postFields, self.deviceCodeFields)
         except pycurl.error as err:
-            msgData = { 'error_code': GDataOAuthError.ERR_NETWORK, 'error_string': c.errstr() }
+            msgData = { 'error_code': GDataOAuthError.ERR_NETWORK, 'error_string': err.args[1] }
             self.applicationCallback(MessageTypes.MSG_OAUTH_FAILED, msgData)
             return
-        finally:
-            c.close()
+        except ValueError as err:
+            self.applicationCallback(MessageTypes.MSG_OAUTH_FAILED, self.__invalidResponseMessage(err))
+            return
             
         #Start handling the response.
         if(responsecode == 200):
             msgData = { 'user_code': reqResp['user_code'],
                         'verification_url': reqResp['verification_url'],
                         'expires_in': reqResp['expires_in'] }
-            self.interval = reqResp['interval']
+            self.interval = int(reqResp.get('interval', self.defaultPollInterval))
             self.deviceCode = reqResp['device_code']
+            self.deviceCodeExpiration = time.time() + int(reqResp['expires_in'])
             self.applicationCallback(MessageTypes.MSG_VERIFICATION_REQUIRED, msgData)
             self.startPolling()
-            
-        elif(responsecode == 400):
-            msgData = { 'error_code': GDataOAuthError.ERR_PROTOCOL, 'error_string': reqResp['error'] }
-            self.applicationCallback(MessageTypes.MSG_OAUTH_FAILED, msgData)
-        elif(responsecode == 401):
-            msgData = { 'error_code': GDataOAuthError.ERR_CREDENTIALS, 'error_string': reqResp['error'] }
-            self.applicationCallback(MessageTypes.MSG_OAUTH_FAILED, msgData)
         else:
-            msgData = { 'error_code': GDataOAuthError.ERR_UNKNOWN, 'error_string': reqResp['error'] }
-            self.applicationCallback(MessageTypes.MSG_OAUTH_FAILED, msgData)
+            self.applicationCallback(MessageTypes.MSG_OAUTH_FAILED, self.__failureMessage(responsecode, reqResp))
             
     #-----------------------------------------------------------------------------------------#
     def startPolling(self):
@@ -202,126 +310,144 @@ Error Types:
         #Notify the GUI that we are polling
         self.applicationCallback(MessageTypes.MSG_CLIENT_WAITING, {} )
 
+        #The device code is the same for every poll
+        postFields = self.__pollFieldsPrefix + "&code=" + quote_plus(self.deviceCode)
+
         keepPolling = True
         while(keepPolling):
-            time.sleep(self.interval)
-            postData = {
-                'client_id': self.clientId,
-                'client_secret': self.clientSecret,
-                'code': self.deviceCode,
-                'grant_type': self.grantType }
-            postFields = urlencode(postData)
-
-            buffer = BytesIO()
-            c = pycurl.Curl()
-            try:
-                c.setopt(c.URL, self.pollServer)
-                c.setopt(c.POSTFIELDS, postFields)
-                c.setopt(c.WRITEDATA, buffer)
-                c.perform()
+            #Once the device code has expired the user can no longer authorize it, so stop holding this thread.
+            if((time.time() + self.interval) > self.deviceCodeExpiration):
+                msgData = { 'error_code': GDataOAuthError.ERR_AUTH_FAILED, 'error_string': "expired_token: User did not authorize in time" }
+                self.applicationCallback(MessageTypes.MSG_OAUTH_FAILED, msgData)
+                return
+            #Wait for the next poll, returning early if the authorization is cancelled
+            if(self.__cancelEvent.wait(self.interval)):
+                msgData = { 'error_code': GDataOAuthError.ERR_AUTH_FAILED, 'error_string': "Authorization cancelled" }
+                self.applicationCallback(MessageTypes.MSG_OAUTH_FAILED, msgData)
+                return
 
-                responsecode = c.getinfo(c.RESPONSE_CODE)
-                reqResp = json.loads(buffer.getvalue().decode('iso-8859-1'))
+            try:
+                responsecode, reqResp = self.__postForJSON(self.pollServer, postFields, self.tokenFields)
             except pycurl.error as err:
-                msgData = { 'error_code': GDataOAuthError.ERR_NETWORK, 'error_string': c.errstr() }
+                msgData = { 'error_code': GDataOAuthError.ERR_NETWORK, 'error_string': err.args[1] }
                 self.applicationCallback(MessageTypes.MSG_OAUTH_FAILED, msgData)
                 return
-            finally:
-                c.close()
+            except ValueError as err:
+                self.applicationCallback(MessageTypes.MSG_OAUTH_FAILED, self.__invalidResponseMessage(err))
+                return
             
             if(responsecode == 200):
                 keepPolling = False
                 expiration = int(time.time()) + int(reqResp['expires_in'])
                 token = OAuth2Token(reqResp['refresh_token'], reqResp['token_type'], reqResp['access_token'], expiration)
                 self.applicationCallback(MessageTypes.MSG_OAUTH_SUCCESS, token)
-            elif(responsecode == 400):
-                errorType = reqResp['error']
+            else:
                 #The google api has combined legit errors with the "still waiting" response. Need to decide if it's an error or to just try again
+                errorType = reqResp['error']
                 if(errorType == "authorization_pending"):
-                    print("Still waiting...")
+                    #Still waiting on the user, poll again
+                    pass
+                elif(errorType == "slow_down"):
+                    #RFC 8628 requires the interval be increased by 5 seconds for this and all later requests
+                    self.interval += 5
                 else:
                     keepPolling = False
-                    msgData = { 'error_code': GDataOAuthError.ERR_PROTOCOL, 'error_string': reqResp['error'] + ": " + reqResp['error_description']}
-                    self.applicationCallback(MessageTypes.MSG_OAUTH_FAILED, msgData)
-            elif(responsecode == 403):
-                keepPolling = False
-                msgData = { 'error_code': GDataOAuthError.ERR_AUTH_FAILED, 'error_string': reqResp['error'] + ": User cancelled authorization" }
-                self.applicationCallback(MessageTypes.MSG_OAUTH_FAILED, msgData)
-            elif(responsecode == 429):
-                #if we are going too fast. add 2 seconds to the interval
-                print("Too fast, increasing interval..")
-                self.interval += 2
-            else:
-                keepPolling = False
-                msgData = { 'error_code': GDataOAuthError.ERR_UNKNOWN, 'error_string': reqResp['error'] + ": " + reqResp['error_description'] }
-                self.applicationCallback(MessageTypes.MSG_OAUTH_FAILED, msgData)
+                    self.applicationCallback(MessageTypes.MSG_OAUTH_FAILED, self.__failureMessage(responsecode, reqResp))
 
     #----------------------------------------------------------------------------------------------------------------------------------------------#
     def refreshToken(self, token):
-        """Takes a GDataOauth2Client.OAuth2Token and gets a new accessToken for it. """
-        
-        postData = { 'refresh_token': token.refreshToken,
-                     'client_id': self.clientId,
-                     'client_secret': self.clientSecret,
-                     'grant_type': self.refreshGrantType }
-        postFields = urlencode(postData)
+        """Takes a GDataOauth2Client.OAuth2Token and gets a new accessToken for it. 
+        Only one thread refreshes a given token at a time. Threads that were waiting while another refreshed it
+        are called back with the refreshed token instead of sending a second request."""
+
+        #Remember the expiration the caller saw so we can tell if someone else refreshed the token while we waited.
+        callerExpiration = token.expiration
+        with token.refreshLock:
+            if((token.expiration != callerExpiration) and (token.getState() == TokenState.STATE_FRESH)):
+                msgType, msgData = (MessageTypes.MSG_OAUTH_SUCCESS, token)
+            else:
+                token.refreshing = True
+                try:
+                    msgType, msgData = self.__sendRefreshRequest(token)
+                finally:
+                    token.refreshing = False
+
+        self.applicationCallback(msgType, msgData)
+
+    #----------------------------------------------------------------------------------------------------------------------------------------------#
+    def __sendRefreshRequest(self, token):
+        """Send the refresh request and update the token. Returns the (msgType, msgData) to call back with."""
+        postFields = self.__refreshFieldsPrefix + "&refresh_token=" + quote_plus(token.refreshToken)
 
-        
-        buffer = BytesIO()
-        c = pycurl.Curl()
         try:
-            c.setopt(c.URL, self.refreshServer)
-            c.setopt(c.POSTFIELDS, postFields)
-            c.setopt(c.WRITEDATA, buffer)
-            c.perform()
-            
-            responsecode = c.getinfo(c.RESPONSE_CODE)
-            reqResp = json.loads(buffer.getvalue().decode('iso-8859-1'))
+            responsecode, reqResp = self.__postForJSON(self.refreshServer, postFields, self.refreshFields)
         except pycurl.error as err:
-            msgData = { 'error_code': GDataOAuthError.ERR_NETWORK, 'error_string': c.errstr() }
-            self.applicationCallback(MessageTypes.MSG_OAUTH_FAILED, msgData)
-            return
-        finally:
-            c.close()
-
+            msgData = { 'error_code': GDataOAuthError.ERR_NETWORK, 'error_string': err.args[1] }
+            return (MessageTypes.MSG_OAUTH_FAILED, msgData)
+        except ValueError as err:
+            return (MessageTypes.MSG_OAUTH_FAILED, self.__invalidResponseMessage(err))
 
         if(responsecode == 200):
             expiration = int(time.time()) + int(reqResp['expires_in'])
             token.accessToken = reqResp['access_token']
             token.expiration = expiration
             token.tokenType =  reqResp['token_type']
-            self.applicationCallback(MessageTypes.MSG_OAUTH_SUCCESS, token);
-        elif(responsecode == 401):
-            msgData = { 'error_code': GDataOAuthError.ERR_CREDENTIALS, 'error_string': reqResp['error'] }
-            self.applicationCallback(MessageTypes.MSG_OAUTH_FAILED, msgData)
-        elif(responsecode == 400):
-            msgData = { 'error_code': GDataOAuthError.ERR_PROTOCOL, 'error_string': reqResp['error'] + ": " + reqResp['error_description']}
-            self.applicationCallback(MessageTypes.MSG_OAUTH_FAILED, msgData)
+            return (MessageTypes.MSG_OAUTH_SUCCESS, token)
         else:
-            msgData = { 'error_code': GDataOAuthError.ERR_UNKNOWN, 'error_string': reqResp['error'] + ": " + reqResp['error_description'] }
-            self.applicationCallback(MessageTypes.MSG_OAUTH_FAILED, msgData)
+            return (MessageTypes.MSG_OAUTH_FAILED, self.__failureMessage(responsecode, reqResp))
 
 ####################################################################################################################################################
 # OAuth2 Token                                                                                                                                     #
 ####################################################################################################################################################
 class OAuth2Token:
     """This class represents an OAuth token that can be saved and loaded so that it is persistent"""
+
+    #Number of seconds before expiration that an access token is considered stale
+    expirationMargin = 60
     
     def __init__(self, refreshToken, tokenType, accessToken=None, expiration=0):
         self.refreshToken = refreshToken
         self.accessToken = accessToken
         self.tokenType = tokenType
         self.expiration = expiration
+        #Held while the access token is being refreshed
+        self.refreshLock = threading.Lock()
+        self.refreshing = False
+        #Cached authorization header and the access token it was built from
+        self.__authHeader = None
+        self.__authHeaderToken = None
+
+    def getState(self):
+        """Returns the TokenState of the access token. Does not take the refresh lock."""
+        if(self.refreshing):
+            return TokenState.STATE_REFRESHING
+        elif((self.accessToken is not None) and ((self.expiration - time.time()) > self.expirationMargin)):
+            return TokenState.STATE_FRESH
+        else:
+            return TokenState.STATE_STALE
+
+    def getAuthorizationHeader(self):
+        """Returns the HTTP Authorization header for the current access token.
+        The header is only rebuilt when the access token changes."""
+        if((self.__authHeader is None) or (self.__authHeaderToken != self.accessToken)):
+            self.__authHeader = "Authorization: Bearer " + str(self.accessToken)
+            self.__authHeaderToken = self.accessToken
+        return self.__authHeader
 
     #static function
     def serializeToken(token):
-        """Serialize the token into a writeable string for saving"""
-        struct = { 'refreshToken': token.refreshToken, 'token_type': token.tokenType }
+        """Serialize the token into a writeable string for saving.
+        The access token and its expiration are included so a still valid token can be used without refreshing after a restart."""
+        struct = { 'refreshToken': token.refreshToken,
+                   'token_type': token.tokenType,
+                   'accessToken': token.accessToken,
+                   'expiration': token.expiration }
         return json.dumps(struct)
 
     def deserializeToken(tokenString):
         tokenArr = json.loads(tokenString)
-        return OAuth2Token(tokenArr['refreshToken'], tokenArr['token_type'])
+        #Tokens saved by older versions only contain the refresh token
+        return OAuth2Token(tokenArr['refreshToken'], tokenArr['token_type'], tokenArr.get('accessToken'), tokenArr.get('expiration', 0))
 
     
 
@@ -10,6 +10,8 @@ PicasaClient - Main class for accessing Picasa APIs
 MessageTypes - Messages that can be sent to the callbacks
 PicasaErrors - Error Codes for the callbacks
 MetadataTags - Supported tags that can be sent to Google Photos
+AlbumFeedParser - Parses an album list feed as it is downloaded
+ResponseHeaderCollector - Collects response headers from curl
 
 Dependencies:
 pycurl
@@ -18,10 +20,14 @@ python3-lxml
 """
 import GDataOauth2Client
 import pycurl
+import threading
+import time
+import uuid
 from enum import Enum
-from io import BytesIO, IOBase
+from io import BytesIO, IOBase, SEEK_END
 from lxml import etree
 from lxml.etree import QName
+from xml.sax.saxutils import escape
 
 #####################################################################################################
 # MessageTypes - Types of messages that will be sent to the callback function                       #
@@ -64,6 +70,37 @@ class PicasaClient:
        Data formats for MSG_FAILED follow:
           { 'error_type': ERR_UNAUTHORIZED, 'error_string': 'API call could not be authenticated.' }
     """
+    #Used XML namespaces
+    googleNamespaces = {
+        "atom":         "http://www.w3.org/2005/Atom",
+        "gd":         "http://schemas.google.com/g/2005",
+        #"openSearch": "http://http://a9.com/-/spec/opensearch/1.1/",
+        "gphoto":     "http://schemas.google.com/photos/2007",
+        "app":        "http://w3.org/2007/app",
+        "exif":       "http://schemas.google.com/photos/exif/2007",
+        "media":      "http://search.yahoo.com/mrss/" }
+
+    #Album list parsing. The XPath queries are compiled once for all clients since they are run for every album entry.
+    __entryTag = QName(googleNamespaces['atom'], "entry").text
+    __titleXPath = etree.XPath("string(atom:title)", namespaces=googleNamespaces, smart_strings=False)
+    __albumIdXPath = etree.XPath("string(gphoto:id)", namespaces=googleNamespaces, smart_strings=False)
+    __rightsXPath = etree.XPath("string(atom:rights)", namespaces=googleNamespaces, smart_strings=False)
+    __authorXPath = etree.XPath("string(atom:author/atom:name)", namespaces=googleNamespaces, smart_strings=False)
+
+    #Errors reported for unsuccessful response codes. Any other code is reported as ERR_UNKNOWN.
+    responseErrors = {
+        400: PicasaErrors.ERR_PROTOCOL,
+        401: PicasaErrors.ERR_UNAUTHORIZED,
+        403: PicasaErrors.ERR_UNAUTHORIZED }
+
+    #Upload metadata. Elements for each supported MetadataTag are inserted into the entry template.
+    __metadataTemplate = ('<entry xmlns="' + googleNamespaces['atom'] + '">'
+                          '<category scheme="' + googleNamespaces['gd'] + '#kind" term="' + googleNamespaces['gphoto'] + '#photo"/>'
+                          '{}</entry>')
+    __metadataElements = {
+        MetadataTags.TAG_TITLE:   "<title>{}</title>",
+        MetadataTags.TAG_SUMMARY: "<summary>{}</summary>" }
+
     #----------------------------------------------------------------------------------------------#
     def __init__(self, userId="default"):
         """Main constructor. Provide the userID of the account you want to access or detect the one used for the credentials used in the calls.
@@ -73,15 +110,102 @@ class PicasaClient:
         self.userId = userId
         self.picasaBaseURL = "https://picasaweb.google.com/data/feed/api"
 
-        #Used XML namespaces
-        self.googleNamespaces = {
-            "atom":         "http://www.w3.org/2005/Atom",
-            "gd":         "http://schemas.google.com/g/2005",
-            #"openSearch": "http://http://a9.com/-/spec/opensearch/1.1/",
-            "gphoto":     "http://schemas.google.com/photos/2007",
-            "app":        "http://w3.org/2007/app",
-            "exif":       "http://schemas.google.com/photos/exif/2007",
-            "media":      "http://search.yahoo.com/mrss/" }
+        #Headers that are the same for every request
+        self.__feedHeaders = [ "GData-Version: " + self.gDataVersion ]
+        self.__uploadHeaders = self.__feedHeaders + [ "Content-Type: multipart/related" ]
+
+        #Album lists that have been downloaded, keyed by feed url, as (etag, albumList) tuples
+        self.__albumListCache = dict()
+
+        #A single curl handle is reused for every request so libcurl can keep the connection to google alive.
+        #Uploads can legitimately take a long time, so requests are only abandoned if they stop making progress.
+        #Options that are the same for every request are only set once.
+        self.requestTimeout = 30
+        #Minimum number of seconds between progress callbacks
+        self.progressInterval = 0.25
+        self.__curl = GDataOauth2Client.newCurlHandle()
+        self.__curl.setopt(pycurl.CONNECTTIMEOUT, self.requestTimeout)
+        self.__curl.setopt(pycurl.LOW_SPEED_LIMIT, 1)
+        self.__curl.setopt(pycurl.LOW_SPEED_TIME, self.requestTimeout)
+        self.__curlLock = threading.Lock()
+
+    #---------------------------------------------------------------------------------------------#
+    def close(self):
+        """Release the curl handle and any connections it is holding open."""
+        self.__curl.close()
+
+    #---------------------------------------------------------------------------------------------#
+    def __buildHeaders(self, token, staticHeaders):
+        """Returns the list of headers for a request, adding the authorization header if there is a token."""
+        if(token is None):
+            return staticHeaders
+        return staticHeaders + [ token.getAuthorizationHeader() ]
+
+    #---------------------------------------------------------------------------------------------#
+    def __makeFailure(self, responseCode, rspStr):
+        """Returns the MSG_FAILED data for an unsuccessful response"""
+        errorType = self.responseErrors.get(responseCode)
+        if(errorType is None):
+            return { 'error_type': PicasaErrors.ERR_UNKNOWN, 'error_string': str(responseCode) + ": " + rspStr.decode('iso-8859-1') }
+        return { 'error_type': errorType, 'error_string': rspStr.decode('iso-8859-1') }
+
+    #---------------------------------------------------------------------------------------------#
+    def __performRequest(self, url, headers, formData=None, progressFunction=None, bodyStream=None, writeFunction=None, headerFunction=None):
+        """Send a request using the shared curl handle. A multipart POST is sent if formData is provided,
+        a POST streaming its body from bodyStream, a (readFunction, size) tuple, if that is provided, otherwise a GET.
+        If writeFunction is provided, a successful (2xx) response body is given to it as it arrives instead of being kept,
+        so the returned body is empty. Other response bodies are always kept for error reporting.
+        If headerFunction is provided, it is given each response header line.
+        Returns a (responseCode, body) tuple. Raises pycurl.error if the request could not be sent."""
+        body = bytearray()
+        if(writeFunction is None):
+            bodyWriter = body.extend
+        else:
+            #The status of the response the body belongs to, taken from the last status line
+            #since interim responses like 100 Continue have their own.
+            status = [0]
+            def statusHeaderFunction(line):
+                if(line.startswith(b"HTTP/")):
+                    try:
+                        status[0] = int(line.split()[1])
+                    except (IndexError, ValueError):
+                        status[0] = 0
+                if(callerHeaderFunction is not None):
+                    return callerHeaderFunction(line)
+            def bodyWriter(chunk):
+                if(200 <= status[0] < 300):
+                    writeFunction(chunk)
+                else:
+                    body.extend(chunk)
+            callerHeaderFunction = headerFunction
+            headerFunction = statusHeaderFunction
+
+        with self.__curlLock:
+            c = self.__curl
+            c.setopt(c.URL, url)
+            c.setopt(c.HTTPHEADER, headers)
+            c.setopt(c.WRITEFUNCTION, bodyWriter)
+            #The method and progress options are always set since they would otherwise carry over from the previous request
+            if(formData is not None):
+                c.setopt(c.HTTPPOST, formData)
+            elif(bodyStream is not None):
+                c.setopt(c.POST, 1)
+                c.setopt(c.READFUNCTION, bodyStream[0])
+                c.setopt(c.POSTFIELDSIZE_LARGE, bodyStream[1])
+            else:
+                c.setopt(c.HTTPGET, 1)
+            if(progressFunction is not None):
+                c.setopt(c.XFERINFOFUNCTION, progressFunction)
+                c.setopt(c.NOPROGRESS, False)
+            else:
+                c.setopt(c.NOPROGRESS, True)
+            if(headerFunction is not None):
+                c.setopt(c.HEADERFUNCTION, headerFunction)
+            else:
+                c.unsetopt(c.HEADERFUNCTION)
+            c.perform()
+            responseCode = c.getinfo(c.RESPONSE_CODE)
+        return (responseCode, body)
 
     #---------------------------------------------------------------------------------------------#
     def getAlbumList(self, token, callback):
@@ -90,88 +214,65 @@ class PicasaClient:
              token - OAuth Token
              callback - Callback to send list to.
            Calls back with a list of dictionaries with album metadata. Ex:
-           {'albumId': '10000000000000000', 'accessRights': 'protected', 'author': 'Scott McKittrick', 'title': 'Auto Backup'}"""
+           {'albumId': '10000000000000000', 'accessRights': 'protected', 'author': 'Scott McKittrick', 'title': 'Auto Backup'}
+           The list is cached, and later calls only download it again if the server reports it has changed."""
         url = self.picasaBaseURL + "/user/" + self.userId
-        if token is not None:
-            headers = [
-                "GData-Version: " + self.gDataVersion,
-                "Authorization: Bearer " + str(token.accessToken)]
-        else:
-            headers = [ "GData-Version: " + self.gDataVersion ]
+        headers = self.__buildHeaders(token, self.__feedHeaders)
 
-        buffer = BytesIO()
-        c = pycurl.Curl()
-        try:
-            c.setopt(c.URL, url)
-            c.setopt(c.HTTPHEADER, headers)
-            c.setopt(c.WRITEDATA, buffer)
-            c.perform()
+        #If the list has been fetched before, only ask for it again if it has changed.
+        cachedList = self.__albumListCache.get(url)
+        if(cachedList is not None):
+            headers = headers + [ "If-None-Match: " + cachedList[0] ]
+        responseHeaders = ResponseHeaderCollector()
 
-            responseCode = c.getinfo(c.RESPONSE_CODE)
-            rspStr = buffer.getvalue()
-        except pycurl.error:
-            msgData = { 'error_code': PicasaErrors.ERR_NETWORK, 'error_string': c.errstr() }
+        #The feed is parsed while it downloads rather than after
+        feedParser = AlbumFeedParser(self.__entryTag, self.__parseAlbumListEntry)
+        try:
+            responseCode, rspStr = self.__performRequest(url, headers, writeFunction=feedParser.feed, headerFunction=responseHeaders.addLine)
+        except pycurl.error as err:
+            msgData = { 'error_type': PicasaErrors.ERR_NETWORK, 'error_string': err.args[1] }
             callback(MessageTypes.MSG_FAILED, msgData)
             return
-        finally:
-            c.close()
 
         if(responseCode == 200):
-            albumList = self.__parseAlbumList(rspStr)
-            callback(MessageTypes.MSG_SUCCESS, albumList)
-            
-        elif(responseCode == 400):
-            msgData = { 'error_type': PicasaErrors.ERR_PROTOCOL, 'error_string': rspStr.decode('iso-8859-1') }
-            callback(MessageTypes.MSG_FAILED, msgData)
-        elif((responseCode == 403) or (responseCode == 401)):
-            msgData = { 'error_type': PicasaErrors.ERR_UNAUTHORIZED, 'error_string': rspStr.decode('iso-8859-1') }
-            callback(MessageTypes.MSG_FAILED, msgData)
+            try:
+                albumList = feedParser.close()
+            except etree.XMLSyntaxError as err:
+                msgData = { 'error_type': PicasaErrors.ERR_PROTOCOL, 'error_string': "Invalid album feed: " + str(err) }
+                callback(MessageTypes.MSG_FAILED, msgData)
+                return
+            etag = responseHeaders.get("etag")
+            if(etag is not None):
+                self.__albumListCache[url] = (etag, albumList)
+            callback(MessageTypes.MSG_SUCCESS, list(albumList))
+
+        elif((responseCode == 304) and (cachedList is not None)):
+            callback(MessageTypes.MSG_SUCCESS, list(cachedList[1]))
         else:
-            msgData = { 'error_type': PicasaErrors.ERR_UNKNOWN, 'error_string': str(responseCode) + ": " + rspStr.deocde('iso-8859-1')}
-            callback(MessageTypes.MSG_FAILED, msgData)
+            callback(MessageTypes.MSG_FAILED, self.__makeFailure(responseCode, rspStr))
 
     #---------------------------------------------------------------------------------------------#
     def getPhotoList(self, albumId, token, callback):
-        """Retreives a list of albums for the given user.
+        """Retreives the list of photos in an album.
            Takes:
+             albumId - The ID of the album
              token - OAuth Token
              callback - Callback to send list to.
-           This function is only partially implemented for testing purposes. """
+           This function is only partially implemented for testing purposes. It calls back with the unparsed album feed. """
         url = self.picasaBaseURL + "/user/" + self.userId + "/albumid/" + albumId
-        print(url)
-        headers = [
-            "GData-Version: " + self.gDataVersion ]
-        if(token is not None):
-            headers.append("Authorization: Bearer " + str(token.accessToken))
-
-        buffer = BytesIO()
-        c = pycurl.Curl()
-        try:
-            c.setopt(c.URL, url)
-            c.setopt(c.HTTPHEADER, headers)
-            c.setopt(c.WRITEDATA, buffer)
-            c.perform()
+        headers = self.__buildHeaders(token, self.__feedHeaders)
 
-            responseCode = c.getinfo(c.RESPONSE_CODE)
-            rspStr = buffer.getvalue()
-        except pycurl.error:
-            msgData = { 'error_code': PicasaErrors.ERR_NETWORK, 'error_string': c.errstr() }
+        try:
+            responseCode, rspStr = self.__performRequest(url, headers)
+        except pycurl.error as err:
+            msgData = { 'error_type': PicasaErrors.ERR_NETWORK, 'error_string': err.args[1] }
             callback(MessageTypes.MSG_FAILED, msgData)
             return
-        finally:
-            c.close()
 
         if(responseCode == 200):
-            print(rspStr.decode('iso-8859-1'))
-        elif(responseCode == 400):
-            msgData = { 'error_type': PicasaErrors.ERR_PROTOCOL, 'error_string': rspStr.decode('iso-8859-1') }
-            callback(MessageTypes.MSG_FAILED, msgData)
-        elif((responseCode == 403) or (responseCode == 401)):
-            msgData = { 'error_type': PicasaErrors.ERR_UNAUTHORIZED, 'error_string': rspStr.decode('iso-8859-1') }
-            callback(MessageTypes.MSG_FAILED, msgData)
+            callback(MessageTypes.MSG_SUCCESS, rspStr)
         else:
-            msgData = { 'error_type': PicasaErrors.ERR_UNKNOWN, 'error_string': str(responseCode) + ": " + rspStr.deocde('iso-8859-1')}
-            callback(MessageTypes.MSG_FAILED, msgData)
+            callback(MessageTypes.MSG_FAILED, self.__makeFailure(responseCode, rspStr))
 
     #----------------------------------------------------------------------------------------------------#
     def uploadPhoto(self, photo, metadata, albumId, token, callback):
@@ -193,117 +294,176 @@ class PicasaClient:
         #Generate metadata to be sent
         xmlString = self.__generateMetadataXML(metadata)
 
-        headers = [
-            "GData-Version: " + self.gDataVersion,
-            "Content-Type: multipart/related"
-        ]
-
-        if token is not None:
-            headers.append("Authorization: Bearer " + str(token.accessToken))
-
-        data = [
-            ( 'metadata', (pycurl.FORM_CONTENTS, xmlString, pycurl.FORM_CONTENTTYPE, 'application/atom+xml'))
-        ]
-
-
         #Check to see if this is a filename or a file like object
+        #File like objects are streamed to the server rather than copied into a buffer for curl.
         if(isinstance(photo, IOBase)):
-            data.append(('file', (pycurl.FORM_BUFFERPTR, photo.getvalue(), pycurl.FORM_CONTENTTYPE, "image/jpeg")))
+            data = None
+            boundary, bodyStream = self.__buildMultipartStream(xmlString, photo)
+            headers = self.__buildHeaders(token, self.__feedHeaders + [ "Content-Type: multipart/related; boundary=" + boundary ])
         else:
-            data.append(('file', (pycurl.FORM_FILE, photo, pycurl.FORM_CONTENTTYPE, "image/jpeg")))
+            data = [
+                ( 'metadata', (pycurl.FORM_CONTENTS, xmlString, pycurl.FORM_CONTENTTYPE, 'application/atom+xml')),
+                ( 'file', (pycurl.FORM_FILE, photo, pycurl.FORM_CONTENTTYPE, "image/jpeg"))
+            ]
+            bodyStream = None
+            headers = self.__buildHeaders(token, self.__uploadHeaders)
 
         #Send the file and get the response.
         url = self.picasaBaseURL + "/user/" + self.userId + "/albumid/" + albumId
         try:
-            buffer = BytesIO()
-            c = pycurl.Curl()
-            c.setopt(c.POST, 1)
-            c.setopt(c.URL, url)
-            c.setopt(c.WRITEDATA, buffer)
-            c.setopt(c.HTTPHEADER, headers)
-            c.setopt(c.HTTPPOST, data)
-
-            #Add progress updates
-            c.setopt(c.NOPROGRESS, False)
-            c.setopt(c.XFERINFOFUNCTION, lambda dt, dp, ut, up: callback(MessageTypes.MSG_PROGRESS, self.__makeProgressUpdate(dt, dp, ut, up))) 
-            c.perform()
-
-            responseCode = c.getinfo(c.RESPONSE_CODE)
-            rspStr = buffer.getvalue()
-        except pycurl.error:
-            msgData = { 'error_code': PicasaErrors.ERR_NETWORK, 'error_string': c.errstr() }
+            progressFunction = self.__makeProgressFunction(callback)
+            responseCode, rspStr = self.__performRequest(url, headers, data, progressFunction, bodyStream)
+        except pycurl.error as err:
+            msgData = { 'error_type': PicasaErrors.ERR_NETWORK, 'error_string': err.args[1] }
             callback(MessageTypes.MSG_FAILED, msgData)
             return
-        finally:
-            c.close()
 
         if(responseCode == 201):
-            print("Upload successful")
-        elif(responseCode == 400):
-            msgData = { 'error_type': PicasaErrors.ERR_PROTOCOL, 'error_string': rspStr.decode('iso-8859-1') }
-            callback(MessageTypes.MSG_FAILED, msgData)
-        elif((responseCode == 403) or (responseCode == 401)):
-            msgData = { 'error_type': PicasaErrors.ERR_UNAUTHORIZED, 'error_string': rspStr.decode('iso-8859-1') }
-            callback(MessageTypes.MSG_FAILED, msgData)
+            callback(MessageTypes.MSG_SUCCESS, None)
         else:
-            msgData = { 'error_type': PicasaErrors.ERR_UNKNOWN, 'error_string': str(responseCode) + ": " + rspStr.deocde('iso-8859-1')}
-            callback(MessageTypes.MSG_FAILED, msgData)
+            callback(MessageTypes.MSG_FAILED, self.__makeFailure(responseCode, rspStr))
 
     #----------------------------------------------------------------------------------------------------#
-    def __makeProgressUpdate(self, download_total, download_progress, upload_total, upload_progress):
-        """Send a progress update to the gui. This function is used to format the update into the message format for this class"""
-        if(download_total > 0):
-            total = download_total
-            progress = download_progress
-        else:
-            total = upload_total
-            progress = upload_progress
+    def __buildMultipartStream(self, xmlString, photo):
+        """Build a multipart/related upload body made of the metadata xml followed by the photo, read from its current position.
+        Returns the boundary and a (readFunction, size) tuple that curl can read the body from without copying the photo."""
+        boundary = "END_OF_PART_" + uuid.uuid4().hex
+        head = ("--" + boundary + "\r\nContent-Type: application/atom+xml\r\n\r\n").encode() + xmlString + \
+               ("\r\n--" + boundary + "\r\nContent-Type: image/jpeg\r\n\r\n").encode()
+        tail = ("\r\n--" + boundary + "--\r\n").encode()
+
+        #Work out how much of the photo is left to send
+        start = photo.tell()
+        photoSize = photo.seek(0, SEEK_END) - start
+        photo.seek(start)
+
+        parts = [ BytesIO(head), photo, BytesIO(tail) ]
+        def readFunction(size):
+            while(len(parts) > 0):
+                chunk = parts[0].read(size)
+                if(len(chunk) > 0):
+                    return chunk
+                parts.pop(0)
+            return b""
+
+        return (boundary, (readFunction, len(head) + photoSize + len(tail)))
 
-        return { 'total': total, 'progress': progress }
+    #----------------------------------------------------------------------------------------------------#
+    def __makeProgressFunction(self, callback):
+        """Returns a curl progress function that sends progress updates to the callback.
+        Curl calls it many times a second, so updates are only sent at most every progressInterval seconds,
+        and when the transfer completes."""
+        #Time and (total, progress) of the last update sent
+        lastUpdate = [ 0.0, None ]
+        def progressFunction(download_total, download_progress, upload_total, upload_progress):
+            if(download_total > 0):
+                current = (download_total, download_progress)
+            else:
+                current = (upload_total, upload_progress)
+            now = time.monotonic()
+            if((current == lastUpdate[1]) or ((now - lastUpdate[0] < self.progressInterval) and (current[1] < current[0]))):
+                return
+            lastUpdate[0] = now
+            lastUpdate[1] = current
+            callback(MessageTypes.MSG_PROGRESS, { 'total': current[0], 'progress': current[1] })
+        return progressFunction
 
     #----------------------------------------------------------------------------------------------------#
     def __generateMetadataXML(self, metadata):
         """Function to generate metadata xml for image uploads to the google picasa api.
            The api will only accept certain tags, so the MetadataTag class will help prevent invalid tags from being sent. """
 
-        #Create the root element tag
-        root = etree.Element(QName(self.googleNamespaces['atom'], "entry"), nsmap=self.googleNamespaces)
-
-        #Build the category tag
-        category = etree.SubElement(root, QName(self.googleNamespaces['atom'], "category"), nsmap=self.googleNamespaces)
-        category.set("scheme", self.googleNamespaces['gd'] + "#kind")
-        category.set("term", self.googleNamespaces['gphoto'] + "#photo")
-
-        #Insert some metadata.
+        #Only the tag values change between uploads, so they are escaped and substituted into a fixed template.
+        tags = ""
         for key, value in metadata.items():
-            if(key == MetadataTags.TAG_TITLE):
-                title = etree.SubElement(root, QName(self.googleNamespaces['atom'], "title"), nsmap=self.googleNamespaces)
-                title.text = value
-            elif(key == MetadataTags.TAG_SUMMARY):
-                summary = etree.SubElement(root, QName(self.googleNamespaces['atom'], "summary"), nsmap=self.googleNamespaces)
-                summary.text = value
-
-        return etree.tostring(root)
+            #Values that aren't set, like an empty imgSummary in the config, are left out
+            if((key in self.__metadataElements) and (value is not None)):
+                tags += self.__metadataElements[key].format(escape(str(value)))
+
+        return self.__metadataTemplate.format(tags).encode("utf-8")
         
 
-    #----------------------------------------------------------------------------------------------------#
-    def __parseAlbumList(self, xmlFeed):
-        """Function for parsing the xmlResponse of the album list. Returns a list of entries """
-        entryList = list()
-        rspXML = etree.fromstring(xmlFeed)
-        entries = rspXML.findall("atom:entry", namespaces=self.googleNamespaces)
-        for entry in entries:
-            entryMeta = self.__parseAlbumListEntry(entry)
-            entryList.append(entryMeta)
-
-        return entryList
-    
     #----------------------------------------------------------------------------------------------------#
     def __parseAlbumListEntry(self, entryElement):
         """Function for parsing the entry into a list of metadata"""
         entryMeta = dict()
-        entryMeta['title'] = entryElement.find("atom:title", namespaces=self.googleNamespaces).text
-        entryMeta['albumId'] = entryElement.find("gphoto:id", namespaces=self.googleNamespaces).text
-        entryMeta['accessRights'] = entryElement.find("atom:rights", namespaces=self.googleNamespaces).text
-        entryMeta['author'] = entryElement.find("atom:author", namespaces=self.googleNamespaces).find("atom:name", namespaces=self.googleNamespaces).text
+        entryMeta['title'] = self.__titleXPath(entryElement)
+        entryMeta['albumId'] = self.__albumIdXPath(entryElement)
+        entryMeta['accessRights'] = self.__rightsXPath(entryElement)
+        entryMeta['author'] = self.__authorXPath(entryElement)
         return entryMeta
+
+#####################################################################################################
+# ResponseHeaderCollector - Collects response headers from curl                                     #
+#####################################################################################################
+class ResponseHeaderCollector:
+    """Collects the header lines curl passes to its HEADERFUNCTION. Header names are stored in lower case.
+       If curl follows a redirect, only the headers of the last response are kept."""
+
+    #----------------------------------------------------------------------------------------------------#
+    def __init__(self):
+        self.headers = dict()
+
+    #----------------------------------------------------------------------------------------------------#
+    def addLine(self, line):
+        line = line.decode('iso-8859-1')
+        #Each response starts with a status line
+        if(line.startswith("HTTP/")):
+            self.headers = dict()
+            return
+        name, sep, value = line.partition(":")
+        if(sep):
+            self.headers[name.strip().lower()] = value.strip()
+
+    #----------------------------------------------------------------------------------------------------#
+    def get(self, name):
+        """Returns the value of the header, or None if it was not sent"""
+        return self.headers.get(name.lower())
+
+#####################################################################################################
+# AlbumFeedParser - Parses an album list feed as it is downloaded                                   #
+#####################################################################################################
+class AlbumFeedParser:
+    """Incrementally parses an album list feed. Chunks of the feed are given to feed() as they arrive, and each
+       entry is handed to parseEntry as soon as it is complete. close() returns the list of parsed entries."""
+
+    #----------------------------------------------------------------------------------------------------#
+    def __init__(self, entryTag, parseEntry):
+        """Takes the qualified tag of the entry elements and a function that turns an entry element into a dictionary."""
+        self.parseEntry = parseEntry
+        self.entryList = list()
+        self.error = None
+        self.__parser = etree.XMLPullParser(events=("end",), tag=entryTag)
+
+    #----------------------------------------------------------------------------------------------------#
+    def feed(self, chunk):
+        """Parse the next chunk of the feed. Errors are kept until close() since this is called from inside curl."""
+        if(self.error is not None):
+            return
+        try:
+            self.__parser.feed(chunk)
+            self.__readEntries()
+        except etree.XMLSyntaxError as err:
+            self.error = err
+
+    #----------------------------------------------------------------------------------------------------#
+    def close(self):
+        """Finish parsing and return the list of entries. Raises etree.XMLSyntaxError if the feed was not valid xml."""
+        if(self.error is None):
+            try:
+                self.__parser.close()
+                self.__readEntries()
+            except etree.XMLSyntaxError as err:
+                self.error = err
+        if(self.error is not None):
+            raise self.error
+        return self.entryList
+
+    #----------------------------------------------------------------------------------------------------#
+    def __readEntries(self):
+        """Parse every entry completed so far, then drop it and anything before it from the feed element."""
+        for event, entry in self.__parser.read_events():
+            self.entryList.append(self.parseEntry(entry))
+            entry.clear()
+            while(entry.getprevious() is not None):
+                del entry.getparent()[0]
@@ -11,9 +11,9 @@ BasicCountdownOverlayFactory - Factory object for creating countdown overlays
  """
 import os
 import time
+import threading
 from io import BytesIO
 from abc import ABC, ABCMeta, abstractmethod
-import picamera
 from PIL import Image, ImageFont, ImageDraw, ImageOps
 
 ###################################################################
@@ -45,6 +45,9 @@ class AbstractPhotoboothCamera:
         reqPhotoList - A list of (width,height) tuples representing the photos to take 
         callback - A callable that takes a list as the argument"""
         self.resetState()
+        #Each tick is scheduled from when the last one was due rather than sleeping a full second after
+        #the overlay work, so slow overlay rendering doesn't stretch the countdown.
+        nextTick = time.monotonic()
         while True:
             #if we are still counting down, just continue
             if(self.currentCountdown > 0):
@@ -60,6 +63,8 @@ class AbstractPhotoboothCamera:
                     self.displayImage = True
                     self.updateOverlay()
                     self.currentCountdown = self.resultShowLength
+                    #Show the result for the full time no matter how long the capture took
+                    nextTick = time.monotonic()
                 #if we are displaying a result image
                 else:
                     #if wehave enough images
@@ -72,7 +77,8 @@ class AbstractPhotoboothCamera:
                         self.displayImage = False
                         #set the resolution of the next image
                         self.setCaptureResolution(reqPhotoList[len(self.imgList)])
-            time.sleep(1)
+            nextTick += 1
+            time.sleep(max(0, nextTick - time.monotonic()))
         #return the list of images
         callback(self.imgList)
 
@@ -121,11 +127,32 @@ class PhotoboothCameraPi(AbstractPhotoboothCamera):
     #-------------------------------------------------#
     def __init__(self, previewWidth, previewHeight):
         super().__init__()
+        #picamera is slow to import on a Pi, so it is only imported once the camera is created, after the gui is showing.
+        import picamera
         self.camera = picamera.PiCamera()
         self.previewWidth = previewWidth
         self.previewHeight = previewHeight
         self.overlayFactory = None
         self.__overlayHandle = None
+        #The (size, format, window) the current overlay was created with and the bytes it is showing
+        self.__overlayFormat = None
+        self.__overlayBytes = None
+        #The last photo taken and its scaled overlay, as a (photo, bytes, size, mode, window) tuple
+        self.__resultOverlay = None
+        #The jpeg data of the last photo taken
+        self.__lastCapture = None
+        #Padded countdown overlays keyed by countdown value, as (overlay image, bytes, size, mode) tuples.
+        #prepareOverlays fills these from another thread, so they are only used with the lock held.
+        self.__countdownOverlays = dict()
+        self.__countdownLock = threading.Lock()
+
+    #-------------------------------------------------#
+    def prepareOverlays(self):
+        """Render the countdown overlays ahead of time so the first countdown doesn't have to.
+        This can be called from a background thread once the overlay factory is set up."""
+        if(self.overlayFactory != None):
+            for countdown in range(1, self.countDownLength + 1):
+                self.__getCountdownOverlay(countdown)
 
     #-------------------------------------------------#
     def start_preview(self):
@@ -139,68 +166,128 @@ class PhotoboothCameraPi(AbstractPhotoboothCamera):
     def updateOverlay(self):
         #show the countdown
         if((not self.displayImage) and (self.overlayFactory != None)):
-            oImg = self.overlayFactory.getOverlayImage(self.currentCountdown, self.previewWidth, self.previewHeight)
-                
-            #One difficulty of working with overlay renderers is that they expect unencoded RGB input which is padded
-            #up to the camera’s block size. The camera’s block size is 32x16 so any image data provided to a renderer
-            #must have a width which is a multiple of 32, and a height which is a multiple of 16. The specific RGB
-            #format expected is interleaved unsigned bytes. If all this sounds complicated, don’t worry; it’s quite
-            #simple to produce in practice.
-            #Padding up to the required size
-            paddedImg = Image.new(oImg.mode, (
-                ((oImg.size[0] + 31) // 32) * 32,
-                ((oImg.size[1] + 15) // 16) * 16,
-            ))
-            paddedImg.paste(oImg, (0, 0))
-            
-            #create overlay behind, then flip and remove old one
-            #Pillow Image object uses upper case mode names (e.g. "RGBA") but picamera uses lower case (e.g. "rgba")
-            tmpOverlayHandle = self.camera.add_overlay(paddedImg.tobytes(), oImg.size, oImg.mode.lower())
-            if(self.__overlayHandle != None):
-                self.__overlayHandle.layer = 1
-            tmpOverlayHandle.layer = 3
-            if(self.__overlayHandle != None):
-                self.camera.remove_overlay(self.__overlayHandle)
-            self.__overlayHandle = tmpOverlayHandle
+            overlayBytes, overlaySize, overlayMode = self.__getCountdownOverlay(self.currentCountdown)
+
+            self.__showOverlay(overlayBytes, overlaySize, overlayMode)
         #show the result image
         elif(self.displayImage):
-            #scale the image to not take the entire screen
-            #also add a black border 5 pixels wide
-            resultImage = ImageOps.expand(self.imgList[-1], 5, "black")
-            scaleFactor = 0.75
-            scaledSize = ((self.previewWidth * scaleFactor), (self.previewHeight * scaleFactor))
-            resultImage.thumbnail(scaledSize)
-
-            #place it on a transparent field the full screen size
-            paddedImg = Image.new('RGBA', (
-                ((self.previewWidth + 31) // 32) * 32,
-                ((self.previewHeight + 15) // 16) * 16,
-                ))
-            paddedImg.paste(resultImage, ((self.previewWidth - resultImage.size[0]) // 2, (self.previewHeight - resultImage.size[1]) // 2 ))
-
-            #Create the overlay behind and then flip and remove the old one.
-            tmpOverlayHandle = self.camera.add_overlay(paddedImg.tobytes(), (self.previewWidth, self.previewHeight), 'rgba')
-            if(self.__overlayHandle != None):
-                self.__overlayHandle.layer = 1
-            tmpOverlayHandle.layer = 3
-            if(self.__overlayHandle != None):
-                self.camera.remove_overlay(self.__overlayHandle)
-            self.__overlayHandle = tmpOverlayHandle
-            
-            
+            #The result is shown for several ticks, so it is only scaled the first time
+            if((self.__resultOverlay is None) or (self.__resultOverlay[0] is not self.imgList[-1])):
+                self.__resultOverlay = (self.imgList[-1],) + self.__renderResultOverlay(Image.open(BytesIO(self.__lastCapture)))
+            overlayBytes, overlaySize, overlayMode, overlayWindow = self.__resultOverlay[1:]
+
+            self.__showOverlay(overlayBytes, overlaySize, overlayMode, overlayWindow)
+
+    #-----------------------------------------------------#
+    def __renderResultOverlay(self, image):
+        """Scale a photo for display over the preview. Returns a (bytes, size, mode, window) tuple ready to pass to add_overlay.
+        Photos are shown as rgb unless they have transparency, which is kept as rgba."""
+        #scale the image to not take the entire screen
+        #also add a black border 5 pixels wide
+        scaleFactor = 0.75
+        scaledSize = ((self.previewWidth * scaleFactor), (self.previewHeight * scaleFactor))
+        #Let the jpeg decoder scale the photo down while decoding, since it is only displayed at screen size
+        image.draft('RGB', (int(scaledSize[0]), int(scaledSize[1])))
+        if(('A' in image.getbands()) or ('transparency' in image.info)):
+            mode = 'RGBA'
+        else:
+            mode = 'RGB'
+        resultImage = ImageOps.expand(image.convert(mode), 5, "black")
+        resultImage.thumbnail(scaledSize)
+
+        #Rather than placing the photo on a transparent field the full screen size,
+        #only the photo itself is sent and the overlay window centers it on the screen.
+        paddedSize = self.__paddedSize(resultImage.size)
+        if(paddedSize == resultImage.size):
+            paddedImg = resultImage
+        else:
+            paddedImg = Image.new(mode, paddedSize)
+            paddedImg.paste(resultImage, (0, 0))
+        window = ((self.previewWidth - resultImage.size[0]) // 2, (self.previewHeight - resultImage.size[1]) // 2,
+                  resultImage.size[0], resultImage.size[1])
+        return (paddedImg.tobytes(), resultImage.size, mode.lower(), window)
+
+    #-----------------------------------------------------#
+    def __showOverlay(self, overlayBytes, size, mode, window=None):
+        """Display the padded overlay bytes, full screen or in a (x, y, width, height) window. The existing overlay is
+        updated in place when it has the same size, format and window, so the camera doesn't have to allocate a new overlay every tick."""
+        if((self.__overlayHandle != None) and (self.__overlayFormat == (size, mode, window))):
+            #Nothing to do if the overlay is already showing these bytes
+            if(overlayBytes is not self.__overlayBytes):
+                self.__overlayHandle.update(overlayBytes)
+                self.__overlayBytes = overlayBytes
+            return
+
+        #create overlay behind, then flip and remove old one
+        if(window is None):
+            tmpOverlayHandle = self.camera.add_overlay(overlayBytes, size, mode)
+        else:
+            tmpOverlayHandle = self.camera.add_overlay(overlayBytes, size, mode, fullscreen=False, window=window)
+        if(self.__overlayHandle != None):
+            self.__overlayHandle.layer = 1
+        tmpOverlayHandle.layer = 3
+        if(self.__overlayHandle != None):
+            self.camera.remove_overlay(self.__overlayHandle)
+        self.__overlayHandle = tmpOverlayHandle
+        self.__overlayFormat = (size, mode, window)
+        self.__overlayBytes = overlayBytes
+
+    #-----------------------------------------------------#
+    def __paddedSize(self, size):
+        """Returns the size rounded up to the camera's 32x16 block size"""
+        return (((size[0] + 31) // 32) * 32, ((size[1] + 15) // 16) * 16)
+
+    #-----------------------------------------------------#
+    def __getCountdownOverlay(self, countdown):
+        """Returns the countdown overlay for a value as a (bytes, size, mode) tuple ready to pass to add_overlay.
+        The padded bytes are reused for as long as the overlay factory returns the same image for the value."""
+        oImg = self.overlayFactory.getOverlayImage(countdown, self.previewWidth, self.previewHeight)
+        with self.__countdownLock:
+            cached = self.__countdownOverlays.get(countdown)
+            if((cached is None) or (cached[0] is not oImg)):
+                cached = (oImg,) + self.__padOverlayImage(oImg)
+                self.__countdownOverlays[countdown] = cached
+        return cached[1:]
+
+    #-----------------------------------------------------#
+    def __padOverlayImage(self, oImg):
+        """Pad an overlay image for the camera. Returns a (bytes, size, mode) tuple ready to pass to add_overlay."""
+        #One difficulty of working with overlay renderers is that they expect unencoded RGB input which is padded
+        #up to the camera’s block size. The camera’s block size is 32x16 so any image data provided to a renderer
+        #must have a width which is a multiple of 32, and a height which is a multiple of 16. The specific RGB
+        #format expected is interleaved unsigned bytes. If all this sounds complicated, don’t worry; it’s quite
+        #simple to produce in practice.
+        #Padding up to the required size. Common preview sizes such as 1920x1088 are already aligned,
+        #so the copy into a new image is skipped when it isn't needed.
+        paddedSize = self.__paddedSize(oImg.size)
+        if(paddedSize == oImg.size):
+            paddedImg = oImg
+        else:
+            paddedImg = Image.new(oImg.mode, paddedSize)
+            paddedImg.paste(oImg, (0, 0))
+
+        #Pillow Image object uses upper case mode names (e.g. "RGBA") but picamera uses lower case (e.g. "rgba")
+        return (paddedImg.tobytes(), oImg.size, oImg.mode.lower())
+
     #-----------------------------------------------------#
     def removeOverlay(self):
         if(self.__overlayHandle != None):
             self.camera.remove_overlay(self.__overlayHandle)
             self.__overlayHandle = None
+            self.__overlayFormat = None
+            self.__overlayBytes = None
 
     #-----------------------------------------------------#
     def takePicture(self):
         print("Taking Picture")
         stream = BytesIO()
         self.camera.capture(stream, "jpeg")
-        stream.seek(0)
-        self.imgList.append(Image.open(stream))
+        #The photo is only decoded when it is used. The result overlay decodes its own reduced size copy
+        #so the full size photo is only decoded once, when the template is built.
+        #The image reads from the same bytes, so each capture's jpeg is only held once.
+        self.__lastCapture = stream.getvalue()
+        del stream
+        self.imgList.append(Image.open(BytesIO(self.__lastCapture)))
 
     #-----------------------------------------------------#
     def setCaptureResolution(self, size):
@@ -225,21 +312,51 @@ class BasicCountdownOverlayFactory:
         self.fontSize = 500
         self.fontFile = resDir + os.path.sep + "LuckiestGuy.ttf"
         self.fillColor = (0,0,0,255)
-
+        #The loaded font and the (fontFile, fontSize) it was loaded with
+        self.__font = None
+        self.__fontKey = None
+        #Images that have already been drawn, keyed by everything that affects how they look.
+        #Overlays can be drawn ahead of time on another thread, so the caches and the font are only used with the lock held.
+        self.__imageCache = dict()
+        self.__cacheLock = threading.Lock()
 
     #-----------------------------------------------------#
     def getOverlayImage(self, text, width, height):
-        """Take a string of text, and generate an image centered on screen"""
+        """Take a string of text, and generate an image centered on screen.
+        The countdown only uses a few values, so images are cached and the same image is returned for the same text.
+        Don't modify the returned image."""
+        imageKey = (str(text), width, height, self.fontFile, self.fontSize, self.fillColor)
+        with self.__cacheLock:
+            if(imageKey not in self.__imageCache):
+                self.__imageCache[imageKey] = self.__drawOverlayImage(text, width, height)
+            return self.__imageCache[imageKey]
+
+    #-----------------------------------------------------#
+    def __drawOverlayImage(self, text, width, height):
+        """Draw the text centered on a transparent image"""
         #Calculate the size of the image.
-        font = ImageFont.truetype(self.fontFile, self.fontSize)
+        font = self.__getFont()
         im = Image.new("RGBA", (width, height), (0,0,0,0))
 
         #Actually draw the text on the image.
         draw = ImageDraw.Draw(im)
-        w,h = draw.textsize(str(text), font)
+        #textsize was removed in Pillow 10, textbbox is only available from Pillow 8
+        if(hasattr(draw, "textbbox")):
+            w,h = draw.textbbox((0, 0), str(text), font)[2:]
+        else:
+            w,h = draw.textsize(str(text), font)
         draw.text(((width-w)/2,(height-h)/2), str(text), self.fillColor, font)
         return im
     
+    #-----------------------------------------------------#
+    def __getFont(self):
+        """Return the font to draw with. The font file is only loaded again if fontFile or fontSize has changed."""
+        fontKey = (self.fontFile, self.fontSize)
+        if(self.__fontKey != fontKey):
+            self.__font = ImageFont.truetype(self.fontFile, self.fontSize)
+            self.__fontKey = fontKey
+        return self.__font
+
     #-----------------------------------------------------#
     def setColorHex(self, hexStr):
         #convert to rgb tuple
@@ -10,19 +10,14 @@ LocalPhotoStorage - Stores the photos in a configured location on the harddrive
 
 """
 import time
-import math
+import itertools
 import os
+import queue
+import threading
 from abc import ABC, ABCMeta, abstractmethod
 
-from PyQt5.QtCore import QObject, pyqtSignal
+from PyQt5.QtCore import QObject, pyqtSignal, Qt
 
-import GDataOauth2Client
-from GDataOauth2Client import MessageTypes as GDOMessageTypes
-from GDataOauth2Client import OAuth2Token as GDOAuth2Token
-from GDataOauth2Client import GDataOAuthError
-from GDataPicasaClient import PicasaClient, PicasaErrors
-from GDataPicasaClient import MessageTypes as PicasaMessageTypes
-from GDataPicasaClient import MetadataTags as GMetadataTags
 import json
 from pathlib import Path
 from enum import Enum
@@ -38,13 +33,24 @@ class AbstractPhotoboothDelivery(QObject):
     #PyQtSlots
     photoSaveUpdate = pyqtSignal(str, int, int)
     photoSaveComplete = pyqtSignal(str, bool)
-    
+
+    #Options for encoding images as jpeg. Baseline, unoptimized 4:2:0 jpegs take libjpeg-turbo's fastest encoding path.
+    jpegOptions = { 'format': 'JPEG', 'quality': 85, 'optimize': False, 'progressive': False, 'subsampling': 2 }
+
+    #Counter used to keep generated filenames unique
+    __nameCounter = itertools.count()
 
     #---------------------------------------------------------------------------#
     def __init__(self):
         """Calls the QObject constructor"""
         super().__init__()
     
+    #---------------------------------------------------------------------------#
+    def generateCollisionResistantName(self, extension):
+        """Generates an image filename as 'IMG_<timestamp in ms>_<count>.<ext>'
+        The count is shared by every delivery method, so photos saved in the same millisecond still get different names."""
+        return "IMG_" + str(int(time.time() * 1000)) + "_" + str(next(self.__nameCounter)) + "." + extension
+
     #---------------------------------------------------------------------------#
     @abstractmethod
     def saveImage(self, image):
@@ -57,6 +63,11 @@ class AbstractPhotoboothDelivery(QObject):
         """Get the name of this service"""
         pass
 
+    #--------------------------------------------------------------------------#
+    def close(self):
+        """Finish any outstanding saves before the program exits. Does nothing by default."""
+        pass
+
 ########################################################################
 # LocalPhotoStorage Class                                              #
 ########################################################################
@@ -70,29 +81,69 @@ class LocalPhotoStorage(AbstractPhotoboothDelivery):
         self.storageLocation = storageLocation
         self.completeHandler = None
         self.serviceName = "Local Storage"
+        #Set once the storage directory is known to exist, so it isn't checked on every save
+        self.__storageReady = False
+
+        #Images are encoded and written by a single background thread in the order they were saved,
+        #so saveImage doesn't have to wait for the SD card. The queue is bounded so a slow card holds up new saves
+        #rather than piling up images in memory. close() drains the queue before the program exits.
+        self.__saveQueue = queue.Queue(maxsize=4)
+        self.__saveThread = threading.Thread(target=self.__saveWorker, daemon=True)
+        self.__saveThread.start()
 
-    #---------------------------------------------------------------------------#
-    def __generateCollisionResistantName(self, extension):
-        """Generates the image filename as 'IMG_<timestamp>.<ext>'"""
-        timestamp = int(math.floor(time.time()))
-        return "IMG_" + str(timestamp) + "." + extension
-        
     #---------------------------------------------------------------------------#
     def saveImage(self, image):
+        """Queue the image to be saved. photoSaveComplete is emitted by the writer thread once it has been written."""
+        filename = self.generateCollisionResistantName("jpg")
+        print("Queueing image: " + filename)
+        self.__saveQueue.put((image, filename))
+
+    #---------------------------------------------------------------------------#
+    def close(self):
+        """Write any queued images and stop the writer thread."""
+        self.__saveQueue.put(None)
+        self.__saveThread.join()
+
+    #---------------------------------------------------------------------------#
+    def __saveWorker(self):
+        """Write queued images until close() is called"""
+        while True:
+            item = self.__saveQueue.get()
+            if(item is None):
+                return
+            image, filename = item
+            self.__writeImage(image, filename)
+
+    #---------------------------------------------------------------------------#
+    def __writeImage(self, image, filename):
         """Save the image itself. """
 
+        path = os.path.join(self.storageLocation, filename)
         success = False
         try:
             print("Saving image")
-            if(not os.path.exists(self.storageLocation)):
-                os.makedirs(self.storageLocation)
+            if(not self.__storageReady):
+                os.makedirs(self.storageLocation, exist_ok=True)
+                self.__storageReady = True
         
-            filename = self.__generateCollisionResistantName("jpg")
             print("Filename: " + filename)
-            image.save(self.storageLocation + os.path.sep + filename)
+            #Pillow writes the jpeg in small blocks, so it is encoded in memory first and written to the SD card in one go.
+            #This also means a photo that can't be encoded never creates a file.
+            buffer = BytesIO()
+            image.save(buffer, **self.jpegOptions)
+            #A buffered file writes everything it is given, unlike a raw file which can stop part way.
+            with open(path, 'wb') as imageFile:
+                imageFile.write(buffer.getbuffer())
             success = True
         except:
             print("Error saving file")
+            #Don't leave a partly written file behind
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            #Check the directory again next time in case it was removed
+            self.__storageReady = False
 
         if(success):
             self.photoSaveComplete.emit(self.serviceName, True)
@@ -140,6 +191,12 @@ class GooglePhotoStorage(AbstractPhotoboothDelivery):
 
         #Call the parent constructor
         super().__init__()
+        #The google client modules pull in pycurl and lxml, which are slow to import on a Pi,
+        #so they are only imported once Google Photos is configured.
+        import GDataOauth2Client
+        import GDataPicasaClient
+        self.__oauth2 = GDataOauth2Client
+        self.__picasa = GDataPicasaClient
 
         self.serviceName = "Google Photos"
         
@@ -148,9 +205,12 @@ class GooglePhotoStorage(AbstractPhotoboothDelivery):
         self.clientSecret = clientSecret
 
         self.token = None
+        #The last serialized token and the token values it was made from
+        self.__serializedToken = None
+        self.__serializedTokenKey = None
         if(serializedToken is not None):
             try:
-                self.token = GDOAuth2Token.deserializeToken(serializedToken)
+                self.token = self.__oauth2.OAuth2Token.deserializeToken(serializedToken)
             except Exception as e:
                 print("Warning: Invalid token supplied. - " + str(e))
                 print("Ignoring supplied token")
@@ -159,30 +219,42 @@ class GooglePhotoStorage(AbstractPhotoboothDelivery):
         self.configCallback = None
         self.scopeList = [ "https://picasaweb.google.com/data/" ]
         self.albumList = list()
+        #Ids of the albums in albumList, for checking requested ids
+        self.__albumIds = set()
         self.albumListTime = 0 #time the album list was received. for cacheing purposes.
         self.cacheTimeout = 60 #seconds until the cache is not valid anymore
         self.albumId = None
 
+        #The upload in progress, if any. If google rejects the token during an upload, the upload is sent
+        #again once the token has been refreshed. The connection is direct so the retry runs on the upload thread.
+        self.uploadCall = None
+        self.__uploadRetried = False
+        #Set while an upload is waiting for a refreshed token. Only the first auth message after that is acted on.
+        self.__awaitingUploadToken = False
+        self.messageReceived.connect(self.__onUploadAuthMessage, Qt.DirectConnection)
+
         #Start setting up the clients
-        self.oAuthClient = GDataOauth2Client.OAuth2DeviceClient(self.clientId, self.clientSecret, self.scopeList, self.gDataOAuthCallback)
-        self.picasaClient = PicasaClient()
+        self.oAuthClient = self.__oauth2.OAuth2DeviceClient(self.clientId, self.clientSecret, self.scopeList, self.gDataOAuthCallback)
+        self.picasaClient = self.__picasa.PicasaClient()
 
     #---------------------------------------------------------------------------#
     def gDataOAuthCallback(self, msgType, msgData):
         """Internal callback for oauth calls"""
         #If the server sends a verification code. 
-        if(msgType == GDOMessageTypes.MSG_VERIFICATION_REQUIRED):
+        if(msgType == self.__oauth2.MessageTypes.MSG_VERIFICATION_REQUIRED):
             self.messageReceived.emit(self.StatusMessage.MSG_AUTH_REQUIRED, msgData)
         #if the authorization was successful
-        elif(msgType == GDOMessageTypes.MSG_OAUTH_SUCCESS):
+        elif(msgType == self.__oauth2.MessageTypes.MSG_OAUTH_SUCCESS):
             #Successful requests return a token.
             self.token = msgData
             
-            self.messageReceived.emit(self.StatusMessage.MSG_AUTH_SUCCESS, GDOAuth2Token.serializeToken(self.token))
+            self.messageReceived.emit(self.StatusMessage.MSG_AUTH_SUCCESS, self.__getSerializedToken())
         #If there was an error
-        elif(msgType == GDOMessageTypes.MSG_OAUTH_FAILED):
-            #If the token presented caused an error, get a whole new token
-            if(((msgData['error_code'] == GDataOAuthError.ERR_CREDENTIALS) or (msgData['error_code'] == GDataOAuthError.ERR_PROTOCOL)) and (self.token is not None)):
+        elif(msgType == self.__oauth2.MessageTypes.MSG_OAUTH_FAILED):
+            #If the token presented caused an error, get a whole new token.
+            #An upload can't wait for the user to authorize the device, so in that case the upload fails instead.
+            if(((msgData['error_code'] == self.__oauth2.GDataOAuthError.ERR_CREDENTIALS) or (msgData['error_code'] == self.__oauth2.GDataOAuthError.ERR_PROTOCOL)) and (self.token is not None)
+               and (not self.__awaitingUploadToken)):
                 print("Google refresh token failed, trying to get new token.")
                 self.oAuthClient.requestAuthorization()
             #otherwise the error can't be recovered
@@ -196,8 +268,9 @@ class GooglePhotoStorage(AbstractPhotoboothDelivery):
         """Internal callback for google photos calls"""
         #print("Data callback : " + str(msgType) + " - " + str(msgData))
         print("Handle refresh token, cache data, compare to current. emit correct signal")
-        if(msgType == PicasaMessageTypes.MSG_SUCCESS):
+        if(msgType == self.__picasa.MessageTypes.MSG_SUCCESS):
             self.albumList = msgData
+            self.__albumIds = set(album['albumId'] for album in msgData)
             self.albumListTime = time.time()
             #if the requested album id is correct
             if(self.__checkAlbumId(self.requestedAlbumId)):
@@ -207,8 +280,9 @@ class GooglePhotoStorage(AbstractPhotoboothDelivery):
             else:
                 self.messageReceived.emit(self.StatusMessage.MSG_ALBUM_LIST, self.albumList)
                 
-        elif(msgType == PicasaMessageTypes.MSG_FAILED):
-            if(msgData['error_type'] == PicasaErrors.ERR_UNAUTHORIZED):
+        elif(msgType == self.__picasa.MessageTypes.MSG_FAILED):
+            if(msgData['error_type'] == self.__picasa.PicasaErrors.ERR_UNAUTHORIZED):
+                self.__invalidateAccessToken()
                 self.messageReceived.emit(self.StatusMessage.MSG_UNAUTHORIZED, None)
             else:
                 self.messageReceived.emit(self.StatusMessage.MSG_REQUEST_FAILED, msgData['error_string'])
@@ -218,11 +292,20 @@ class GooglePhotoStorage(AbstractPhotoboothDelivery):
         """Take the current token and get a new one. 
            If the token is missing or invalid callback with auth required. if authorization fails, callback with auth failed"""
         if(self.token is not None):
-            self.oAuthClient.refreshToken(self.token)
+            #A token restored from a previous session may still be valid
+            if(self.token.getState() == self.__oauth2.TokenState.STATE_FRESH):
+                self.gDataOAuthCallback(self.__oauth2.MessageTypes.MSG_OAUTH_SUCCESS, self.token)
+            else:
+                self.oAuthClient.refreshToken(self.token)
         else:
             self.oAuthClient.requestAuthorization()
         
 
+    #---------------------------------------------------------------------------#
+    def cancelAuthorization(self):
+        """Stop waiting for the user to authorize the device. Results in a MSG_AUTH_FAILED message."""
+        self.oAuthClient.cancel()
+
     #---------------------------------------------------------------------------#
     def setAlbumId(self, albumId = None):
         """ get the album id. Check against the list, if it doesn't match return album_list. Cache album list for future calls. cache timeout 30 seconds"""
@@ -243,15 +326,25 @@ class GooglePhotoStorage(AbstractPhotoboothDelivery):
                 self.messageReceived.emit(self.StatusMessage.MSG_ALBUM_LIST, self.albumList)
                 
 
+    #--------------------------------------------------------------------------#
+    def __getSerializedToken(self):
+        """Return the serialized token, only serializing it again when the token has changed."""
+        key = (self.token.refreshToken, self.token.accessToken, self.token.expiration)
+        if(self.__serializedToken is None or key != self.__serializedTokenKey):
+            self.__serializedToken = self.__oauth2.OAuth2Token.serializeToken(self.token)
+            self.__serializedTokenKey = key
+        return self.__serializedToken
+
+    #--------------------------------------------------------------------------#
+    def __invalidateAccessToken(self):
+        """Mark the access token as expired after google rejects it so the next getAccessToken call refreshes it."""
+        if(self.token is not None):
+            self.token.expiration = 0
+
     #--------------------------------------------------------------------------#
     def __checkAlbumId(self, albumId):
         """Check to see if the requested album Id is in the albumList"""
-        for album in self.albumList:
-            if(albumId == album['albumId']):
-                return True
-
-        #if we exit the loop, the requested id wasn't found
-        return False
+        return albumId in self.__albumIds
 
     #-------------------------------------------------------------------------#
     def getServiceName(self):
@@ -262,36 +355,61 @@ class GooglePhotoStorage(AbstractPhotoboothDelivery):
         """Upload the image to google photos"""
 
         #create metadata
-        metadata = { GMetadataTags.TAG_SUMMARY: self.imgSummary,
-                     GMetadataTags.TAG_TITLE: self.generateCollisionResistantName(".jpg") }
+        metadata = { self.__picasa.MetadataTags.TAG_SUMMARY: self.imgSummary,
+                     self.__picasa.MetadataTags.TAG_TITLE: self.generateCollisionResistantName("jpg") }
 
         #Save the image into memory
         buffer = BytesIO()
-        image.save(buffer, format='jpeg')
+        image.save(buffer, **self.jpegOptions)
         buffer.seek(0)
 
-        self.uploadCall = lambda: self.picasaClient.uploadPhoto(buffer, metadata, self.albumId, self.token, self.uploadCallback)
+        def uploadCall():
+            #Retries have to send the photo from the start again
+            buffer.seek(0)
+            self.picasaClient.uploadPhoto(buffer, metadata, self.albumId, self.token, self.uploadCallback)
+        self.uploadCall = uploadCall
+        self.__uploadRetried = False
+        self.__awaitingUploadToken = False
         #send the image
-        self.messageReceived.connect(self.uploadCallback)
         self.uploadCall()
-        self.messageReceived.disconnect(self.uploadCallback)
         
     #-----------------------------------------------------------------------#
     def uploadCallback(self, msgType, data):
-        if(msgType == PicasaMessageTypes.MSG_SUCCESS):
-            self.photoSaveComplete(self.getServiceName(), True)
-        elif(msgType == PicasaMessageTypes.MSG_FAILED):
-            if(data['error_type'] == PicasaErrors.ERR_UNAUTHORIZED):
+        if(msgType == self.__picasa.MessageTypes.MSG_SUCCESS):
+            self.__finishUpload(True)
+        elif(msgType == self.__picasa.MessageTypes.MSG_FAILED):
+            #Refresh the token and try once more if google rejected it
+            if((data['error_type'] == self.__picasa.PicasaErrors.ERR_UNAUTHORIZED) and (not self.__uploadRetried)):
                 print("Refresh token")
+                self.__uploadRetried = True
+                self.__invalidateAccessToken()
+                self.__awaitingUploadToken = True
                 self.getAccessToken()
             else:
-                self.photoSaveComplete(self.getServiceName(), False)
-        elif(msgType == PicasaMessageTypes.MSG_PROGRESS):
+                self.__finishUpload(False)
+        elif(msgType == self.__picasa.MessageTypes.MSG_PROGRESS):
             self.photoSaveUpdate.emit(self.getServiceName(), data['total'], data['progress'])
-        elif(msgType == self.StatusMessage.MSG_AUTH_SUCCESS):
+
+    #-----------------------------------------------------------------------#
+    def __onUploadAuthMessage(self, msgType, data):
+        """Send the upload again once the token has been refreshed. Messages that arrive when no upload is waiting are ignored."""
+        if(not self.__awaitingUploadToken):
+            return
+        if(msgType == self.StatusMessage.MSG_AUTH_SUCCESS):
+            self.__awaitingUploadToken = False
             self.uploadCall()
+        elif(msgType == self.StatusMessage.MSG_AUTH_FAILED):
+            self.__awaitingUploadToken = False
+            self.__finishUpload(False)
+        elif(msgType == self.StatusMessage.MSG_AUTH_REQUIRED):
+            #Nobody is there to enter the code during a save, so stop the device flow and fail the upload
+            self.__awaitingUploadToken = False
+            self.oAuthClient.cancel()
+            self.__finishUpload(False)
 
     #-----------------------------------------------------------------------#
-    def generateCollisionResistantName(self, extension):
-        timestamp = int(math.floor(time.time()))
-        return "IMG_" + str(timestamp) + "." + extension
+    def __finishUpload(self, success):
+        """Report the result of the upload"""
+        self.__awaitingUploadToken = False
+        self.uploadCall = None
+        self.photoSaveComplete.emit(self.getServiceName(), success)
@@ -33,6 +33,7 @@ ImageProcessor - Class that takes a template and provides an interface to use it
 TemplateError  - Exception Class representing errors reading the template file.
 """
 import os
+from concurrent.futures import ThreadPoolExecutor
 from lxml import etree
 from PIL import Image
 
@@ -43,21 +44,31 @@ class TemplateManager:
     """Class that takes a directory, reads all the templates in it and maintains a list of template objects."""
 
     #----------------------------------------------------------------------
-    def __init__(self, dirname):
+    def __init__(self, dirname, previewSize=None):
         """TemplateManager constructor
-        Takes a directory name and searches that directory for photo templates."""
+        Takes a directory name and searches that directory for photo templates.
+        If previewSize is given, each template's preview image is decoded at that size while loading."""
 
         self.templateDir = dirname
+        self.previewSize = previewSize
         print("Template directory: " + self.templateDir)
         self.templateList = list()
 
+        #lxml releases the GIL while parsing and validating, so the templates are read in parallel.
         dirList = os.listdir(dirname)
-        for dir in dirList:
-            try:
-                reader = TemplateReader(self.templateDir + os.path.sep + dir,  TemplateReader.TemplateXMLFilename)
-                self.templateList.append(reader)
-            except TemplateError:
-                print("Error reading: " + dir + ". Not Adding")
+        with ThreadPoolExecutor(max_workers=os.cpu_count() or 1) as executor:
+            for reader in executor.map(self.__readTemplate, dirList):
+                if(reader is not None):
+                    self.templateList.append(reader)
+
+    #------------------------------------------------------------------------#
+    def __readTemplate(self, dir):
+        """Reads the template in the given directory. Returns None if it can't be read."""
+        try:
+            return TemplateReader(self.templateDir + os.path.sep + dir,  TemplateReader.TemplateXMLFilename, self.previewSize)
+        except TemplateError:
+            print("Error reading: " + dir + ". Not Adding")
+            return None
 
     #------------------------------------------------------------------------#
     def getCount(self):
@@ -71,21 +82,12 @@ class TemplateManager:
 
     #-----------------------------------------------------------------------#
     def __iter__(self):
-        self.count = 0
-        return self
-
-    #-----------------------------------------------------------------------#
-    def __next__(self):
-        return self.next()
+        """Iterate over the templates. Each iteration gets its own iterator, so iterations don't interfere."""
+        return iter(self.templateList)
 
     #-----------------------------------------------------------------------#
-    def next(self):
-        if(self.count < len(self.templateList)):
-            cur = self.templateList[self.count]
-            self.count += 1
-            return cur
-        else:
-            raise StopIteration()
+    def __len__(self):
+        return len(self.templateList)
 
         
 ##############################################################
@@ -100,12 +102,23 @@ class TemplateReader:
     TemplateXMLFilename = "template.xml"
     TemplateXSD = "PhotoTemplate.xsd"
     NS = "{http://www.scottmckittrick.com/schema/PiBooth/PhotoTemplate}"
+    NameTag = NS + "name"
+    DescriptionTag = NS + "description"
+    AuthorTag = NS + "author"
+    PreviewImageTag = NS + "previewImage"
+    CanvasTag = NS + "canvas"
+    BackgroundPhotoTag = NS + "backgroundPhoto"
+    ForegroundPhotoTag = NS + "foregroundPhoto"
+    PhotosTag = NS + "photos"
+    #The compiled schema is shared by every template, so it is only loaded once.
+    __schema = None
 
     #----------------------------------------------------------------------
-    def __init__(self, dirname, filename):
+    def __init__(self, dirname, filename, previewSize=None):
         """Template reader constructor
         
         Parses a template package and stores the resultant data for access. 
+        If previewSize is given, the preview image is also loaded as a thumbnail of that size.
         Throws TemplateError when it has problems parsing a template package."""
         self.TemplateDir = dirname
         self.TemplateFilename = self.TemplateDir + os.path.sep + filename
@@ -120,22 +133,21 @@ class TemplateReader:
         self.backgroundPhoto = None
         self.foregroundPhoto = None
         self.photoList = list()
+        self.previewThumbnail = None
 
         try:
             print("Loading Template: " + self.TemplateFilename)
             
-            #load the template xml
-            self.template_xml = etree.parse(self.TemplateFilename)
-
-            #validate agains the XSD file
-            print("Validating template file for " + self.TemplateFilename)
-            if(self.__validateFile() != True):
-                raise TemplateError("Error: XML Validation failed. ")
-            else:
-                print("Validation succeeded!")
+            #load the template xml, validating it against the XSD file as it is parsed
+            parser = etree.XMLParser(schema=TemplateReader.getSchema())
+            self.template_xml = etree.parse(self.TemplateFilename, parser)
+            print("Validation succeeded!")
 
             #Begin parsing the xml for data
             self.__parseFile()
+
+            if(previewSize is not None):
+                self.loadPreviewThumbnail(previewSize)
                 
         except OSError as err:
             print("Error reading Template: " + str(err))
@@ -145,35 +157,32 @@ class TemplateReader:
             raise TemplateError("Error parsing template xml")
 
     #--------------------------------------------------------------------------------
-    def __validateFile(self):
-        """Validates the file against a specific XML Schema Definition document. """
-
-        xml_schema_doc = etree.parse(TemplateReader.TemplateXSD)
-        xmlSchema = etree.XMLSchema(xml_schema_doc)
-        
-        return xmlSchema.validate(self.template_xml)
+    @classmethod
+    def getSchema(cls):
+        """Returns the compiled XML Schema, loading it the first time it is needed."""
+        if(cls.__schema is None):
+            xml_schema_doc = etree.parse(cls.TemplateXSD)
+            cls.__schema = etree.XMLSchema(xml_schema_doc)
+        return cls.__schema
 
     #--------------------------------------------------------------------------------
     def __parseFile(self):
         """Parses the template.xml file and stores the data in the object"""
         root = self.template_xml.getroot()
-        
-        self.templateName = root.find(self.NS+"name").text
-        
-        descriptionElem = root.find(self.NS+"description")
-        if(descriptionElem is not None):
-            self.description = descriptionElem.text
-            
-        authorElem = root.find(self.NS+"author")
-        if(authorElem is not None):
-            self.author = authorElem.text
 
-        previewImageElem = root.find(self.NS+"previewImage")
-        if(previewImageElem is not None):
-            self.previewImageFilename = previewImageElem.get("src")
-
-        canvas = root.find(self.NS+"canvas")
-        self.__parseCanvas(canvas)
+        #Walk the children once instead of searching for each element.
+        for child in root:
+            tag = child.tag
+            if(tag == self.NameTag):
+                self.templateName = child.text
+            elif(tag == self.DescriptionTag):
+                self.description = child.text
+            elif(tag == self.AuthorTag):
+                self.author = child.text
+            elif(tag == self.PreviewImageTag):
+                self.previewImageFilename = child.get("src")
+            elif(tag == self.CanvasTag):
+                self.__parseCanvas(child)
 
     #--------------------------------------------------------------------------------
     def __parseCanvas(self, canvas):
@@ -185,30 +194,26 @@ class TemplateReader:
         self.height = int(canvas.get("height"))
         self.width = int(canvas.get("width"))
 
-        backgroundPhotoElem = canvas.find(self.NS+"backgroundPhoto")
-        if(backgroundPhotoElem is not None):
-            self.backgroundPhoto = self.TemplateDir + os.path.sep + backgroundPhotoElem.get("src")
-
-        foregroundPhotoElem = canvas.find(self.NS+"foregroundPhoto")
-        if(foregroundPhotoElem is not None):
-            self.foregroundPhoto = self.TemplateDir + os.path.sep + foregroundPhotoElem.get("src")
-
-        photoList = canvas.find(self.NS+"photos")
-        self.__parsePhotoList(photoList)
+        for child in canvas:
+            tag = child.tag
+            if(tag == self.BackgroundPhotoTag):
+                self.backgroundPhoto = self.TemplateDir + os.path.sep + child.get("src")
+            elif(tag == self.ForegroundPhotoTag):
+                self.foregroundPhoto = self.TemplateDir + os.path.sep + child.get("src")
+            elif(tag == self.PhotosTag):
+                self.__parsePhotoList(child)
 
     #---------------------------------------------------------------------------------
     def __parsePhotoList(self, photoList):
         """Parses the photo list object and it's contents"""
         self.photoList = list()
-        for photoSpec in photoList.getchildren():
-            height = int(photoSpec.get("height"))
-            width = int(photoSpec.get("width"))
-            x = int(photoSpec.get("x"))
-            y = int(photoSpec.get("y"))
-            if(photoSpec.get("rotation") is None):
-                rot = 0
-            else:
-                rot = int(photoSpec.get("rotation"))
+        for photoSpec in photoList.iterchildren(tag=etree.Element):
+            attrib = photoSpec.attrib
+            height = int(attrib["height"])
+            width = int(attrib["width"])
+            x = int(attrib["x"])
+            y = int(attrib["y"])
+            rot = int(attrib.get("rotation", 0))
                 
             photoSpecTuple = {'x': x, 'y': y, 'width': width, 'height': height, 'rotation': rot}
             self.photoList.append(photoSpecTuple)
@@ -221,6 +226,27 @@ class TemplateReader:
         else:
             return None
 
+    #-----------------------------------------------------------------------#
+    def loadPreviewThumbnail(self, size):
+        """Decode the preview image as a thumbnail that fits within size.
+        draft lets the jpeg decoder scale the image down while decoding instead of decoding it at full size."""
+        previewPath = self.getTemplatePreviewPath()
+        if(previewPath is None):
+            return
+        try:
+            image = Image.open(previewPath)
+            image.draft('RGB', size)
+            image.thumbnail(size, Image.LANCZOS)
+            self.previewThumbnail = image
+        except OSError as err:
+            print("Error reading template preview: " + str(err))
+            self.previewThumbnail = None
+
+    #-----------------------------------------------------------------------#
+    def getPreviewThumbnail(self):
+        """Returns the preview thumbnail as a PIL Image, or None if one wasn't loaded."""
+        return self.previewThumbnail
+
     #-----------------------------------------------------------------------#
     def getMaxImageSize(self):
         """Get the size of the largest image. Currently assumes that all images will be the same aspect ratio"""
@@ -267,7 +293,7 @@ class ImageProcessor:
         for i in range(0, len(self.template.photoList)):
             photoSpec = self.template.photoList[i]
             takenImg = imageList[i].convert("RGBA")
-            takenImg.thumbnail((photoSpec['width'], photoSpec['height']), Image.ANTIALIAS)
+            takenImg.thumbnail((photoSpec['width'], photoSpec['height']), Image.LANCZOS)
             if(photoSpec['rotation'] != 0):
                 tmp = takenImg.rotate(photoSpec['rotation'], Image.BILINEAR, 1)
                 takenImg = tmp
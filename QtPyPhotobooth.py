@@ -16,19 +16,19 @@ from enum import Enum
 import time
 import os
 import threading
+import functools
+from concurrent.futures import ThreadPoolExecutor
 
 import yaml
 
-from PIL import ImageQt
-
 import PyQt5
 from PyQt5.QtWidgets import *
 from PyQt5.QtCore import QTimer,QObject, QSize, Qt, pyqtSlot, QThread
 from PyQt5.QtGui import QStandardItemModel, QStandardItem, QPixmap, QIcon, QImage
 
 import mainwindow_auto
-from PhotoboothCamera import PhotoboothCameraPi, BasicCountdownOverlayFactory
-from PhotoboothTemplate import TemplateManager, ImageProcessor
+#The camera and template modules pull in PIL and lxml, which are slow to import on a Pi.
+#They are imported where they are first used so the main window can be created first.
 from PhotoboothDelivery import LocalPhotoStorage
 from PhotoboothDelivery import GooglePhotoStorage
 from pathlib import Path
@@ -61,16 +61,25 @@ class QtPyPhotobooth(QObject):
         #initialise some members
         self.resourcePath = "." + os.path.sep + "res"
         self.defaultTemplateIcon = "defaultTemplateIcon.png"
+        self.templateIconSize = (200,200)
+        #Template icons keyed by the path of the image they were made from
+        self.templateIcons = dict()
         self.templateModel = None
         self.gPhotoMessageBox = None
         #this is the list of services the image is saved to and their status
         #format 2-Tuple (ServiceName, True (success)/False (failure))
         self.saveList = list()
+        #Delivery methods are set up once the splash screen is showing
+        self.deliveryList = list()
+        #Google Photos network calls run one at a time on a single background thread so they never block the gui
+        self.networkExecutor = ThreadPoolExecutor(max_workers=1)
         
         print("Initializing configuration...")
         self.configFilename = "config.yaml"
-        f = open(self.configFilename, 'r')
-        self.config = yaml.load(f)
+        #The config is plain data, so it is read with the safe loader. The libyaml based one is much faster when it is available.
+        loader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+        with open(self.configFilename, 'r') as f:
+            self.config = yaml.load(f, Loader=loader)
 
         #Get some configuration from the config file
                 #Show the splash screen for a specific amount of time before moving on.
@@ -132,7 +141,15 @@ class QtPyPhotobooth(QObject):
 
         #Add to the splash count for the rest of the configuration tasks
         self.__incrementSplashTriggerCount()
-                                                
+
+        #Let the splash screen paint, then finish configuring once the event loop is running.
+        #The camera and templates take a while to set up, and this way that time is spent behind the splash screen.
+        QApplication.processEvents()
+        QTimer.singleShot(0, self.__finishConfiguration)
+
+    #-----------------------------------------------------------#
+    def __finishConfiguration(self):
+        """Configure the hardware, templates and delivery mechanisms while the splash screen is showing."""
         #Configure the camera
         self.__configureCamera()
 
@@ -142,6 +159,7 @@ class QtPyPhotobooth(QObject):
         #Configure the template list.
         self.__configureTemplates()
         self.__configureTemplateView()
+        self.__checkImageLibrary()
 
         #configure delivery mechanisms
         self.__configureDelivery()
@@ -150,11 +168,7 @@ class QtPyPhotobooth(QObject):
         #It can now remove its trigger from the splash trigger count.
         self.__decrementSplashTriggerCount()
 
-
-
-
-
-        #-----------------------------------------------------------#
+    #-----------------------------------------------------------#
     def __incrementSplashTriggerCount(self):
         self.splashTriggerMutex.acquire(True)
         self.splashTriggerCount += 1
@@ -170,6 +184,18 @@ class QtPyPhotobooth(QObject):
             self.__changeScreens(QtPyPhotobooth.Screens.TEMPLATE)
         self.splashTriggerMutex.release()
 
+    #-----------------------------------------------------------#
+    def __submitNetworkTask(self, fn, *args):
+        """Queue a network call on the background network thread"""
+        future = self.networkExecutor.submit(fn, *args)
+        future.add_done_callback(self.__onNetworkTaskDone)
+
+    #-----------------------------------------------------------#
+    def __onNetworkTaskDone(self, future):
+        """Futures hold on to exceptions, so print them like an ordinary thread would"""
+        if(future.exception() is not None):
+            print("Error in network task: " + repr(future.exception()))
+
     #-----------------------------------------------------------#
     def __configureDelivery(self):
 
@@ -187,7 +213,7 @@ class QtPyPhotobooth(QObject):
                 print("LocalSave configured")
                 if('directory' in method[methodName]):
                     directory = method[methodName]['directory']
-                    self.deliveryList.append(LocalPhotoStorage(directory))
+                    self.__addDeliveryMethod(LocalPhotoStorage(directory))
                 else:
                     print("No directory specified. Not adding LocalSave to delivery mechanisms")
                     continue
@@ -235,8 +261,7 @@ class QtPyPhotobooth(QObject):
                 self.gPhotoDelivery.messageReceived.connect(self.googlePhotosConfigCallback)
 
                 self.__incrementSplashTriggerCount()
-                mThread = threading.Thread(target=self.gPhotoDelivery.getAccessToken)
-                mThread.start()
+                self.__submitNetworkTask(self.gPhotoDelivery.getAccessToken)
                 
             else:
                 print("Unknown delivery mechanism. Not adding")
@@ -250,12 +275,13 @@ class QtPyPhotobooth(QObject):
         #print("GData Config Callback: " + str(msgType) + " - " + str(data))
         if(msgType == self.gPhotoDelivery.StatusMessage.MSG_UNAUTHORIZED):
             #If it is unauthorized, we need to refresh the token
-            mThread = threading.Thread(target=self.gPhotoDelivery.getAccessToken)
-            mThread.start()
+            self.__submitNetworkTask(self.gPhotoDelivery.getAccessToken)
         if(msgType == self.gPhotoDelivery.StatusMessage.MSG_AUTH_REQUIRED):
             print("Google Photos OAuth2 Device Code received.")
             self.gPhotoMessageBox = self.__buildGDataOAuthCodeDialog(data['user_code'], data['verification_url'])
-            self.gPhotoMessageBox.exec_()
+            if(self.gPhotoMessageBox.exec_() == QDialog.Rejected):
+                #The user closed the dialog without authorizing, so stop polling for it.
+                self.gPhotoDelivery.cancelAuthorization()
         elif(msgType == self.gPhotoDelivery.StatusMessage.MSG_AUTH_SUCCESS):
             print("Token Received. Saving...")
             try:
@@ -271,8 +297,7 @@ class QtPyPhotobooth(QObject):
                 print("You will have to reauthorize next time this application is run.")
 
             #Lets try setting the albumId again
-            mThread = threading.Thread(target=self.gPhotoDelivery.setAlbumId, args=[self.gPhotoAlbumId])
-            mThread.start()
+            self.__submitNetworkTask(self.gPhotoDelivery.setAlbumId, self.gPhotoAlbumId)
         elif(msgType == self.gPhotoDelivery.StatusMessage.MSG_AUTH_FAILED):
             print("Authorization Failed")
             self.gPhotoMessageBox.done(1)
@@ -287,11 +312,10 @@ class QtPyPhotobooth(QObject):
             self.gPhotoMessageBox.exec_()
             print("Album Selected: " + self.gPhotoMessageBox.getSelected().text())
             self.gPhotoAlbumId = self.gPhotoMessageBox.getSelected().data(Qt.UserRole)
-            mThread = threading.Thread(target=self.gPhotoDelivery.setAlbumId, args=[self.gPhotoAlbumId])
-            mThread.start()
+            self.__submitNetworkTask(self.gPhotoDelivery.setAlbumId, self.gPhotoAlbumId)
         elif(msgType == self.gPhotoDelivery.StatusMessage.MSG_REQUEST_SUCCEEDED):
             print("Google Photos Delivery Mechanism Configured. Adding...")
-            self.deliveryList.append(self.gPhotoDelivery)
+            self.__addDeliveryMethod(self.gPhotoDelivery)
             self.gPhotoDelivery.messageReceived.disconnect(self.googlePhotosConfigCallback)
             self.__decrementSplashTriggerCount()
         else:
@@ -362,6 +386,7 @@ class QtPyPhotobooth(QObject):
 
         if(cameraTypeStr == "RPI2"):
             print("Starting RPI2")
+            from PhotoboothCamera import PhotoboothCameraPi
             self.camera = PhotoboothCameraPi(self.screenSize.width(), self.screenSize.height())
         elif(cameraTypeStr == "V4L2"):
             print("V4L2 cameras not yet supported.")
@@ -383,6 +408,7 @@ class QtPyPhotobooth(QObject):
             print("No Overlay Function Required")
         elif(overlayTypeStr == "Basic"):
             print("Basic Overlay Specified")
+            from PhotoboothCamera import BasicCountdownOverlayFactory
             self.camera.overlayFactory = BasicCountdownOverlayFactory(self.resourcePath)
             if('overlayOptions' in self.config):
                 oopts = self.config['overlayOptions']
@@ -390,6 +416,8 @@ class QtPyPhotobooth(QObject):
                     self.camera.overlayFactory.fontFile = oopts['font']
                 if('color' in oopts):
                     self.camera.overlayFactory.setColorHex(oopts['color'])
+            #Render the countdown in the background so the first session doesn't have to
+            threading.Thread(target=self.camera.prepareOverlays).start()
         else:
             print("Unknown Overlay Type")
             sys.exit()
@@ -404,8 +432,21 @@ class QtPyPhotobooth(QObject):
             print("No template directory specified. Defaulting to ./templates")
             self.templateDir = os.path.normpath(os.path.abspath("templates"))
             
-        self.templateManager = TemplateManager(self.templateDir)
+        from PhotoboothTemplate import TemplateManager
+        self.templateManager = TemplateManager(self.templateDir, self.templateIconSize)
     
+    #-----------------------------------------------------------#
+    def __checkImageLibrary(self):
+        """Print a tip if Pillow isn't using libjpeg-turbo, since the template images are built and saved with it."""
+        try:
+            from PIL import features
+            turbo = features.check_feature("libjpeg_turbo")
+        except (ImportError, ValueError):
+            #Older Pillow versions can't report it
+            return
+        if(turbo is False):
+            print("Tip: Pillow is not using libjpeg-turbo. See 'Faster Image Processing' in the README for a faster build.")
+
     #-----------------------------------------------------------#
     def __changeScreens(self, screen):
         """Changes the screens on the gui to the selected screen"""
@@ -420,21 +461,19 @@ class QtPyPhotobooth(QObject):
         #create templateListModel class
         #create templatDelegate class
         self.templateModel = QStandardItemModel()
+        items = list()
         for template in self.templateManager:
             item = QStandardItem()
             item.setData(template, Qt.UserRole)
             item.setText(template.templateName)
-            previewPath = template.getTemplatePreviewPath()
-            if(previewPath != None):
-                pixmap = QPixmap(previewPath)
-            else:
-                pixmap = QPixmap(self.resourcePath + os.path.sep + self.defaultTemplateIcon)
-            item.setIcon(QIcon(pixmap))
+            item.setIcon(self.__getTemplateIcon(template))
             #ToDo Add some error handling for missing or unspecified preview images. Include res directory for default icons
-            self.templateModel.appendRow(item)
+            items.append(item)
+        #Add all the rows at once so the model only signals one insert
+        self.templateModel.invisibleRootItem().appendRows(items)
         
         self.templateView.setViewMode(QListView.IconMode)
-        self.templateView.setIconSize(QSize(200,200))
+        self.templateView.setIconSize(QSize(*self.templateIconSize))
         #self.templateView.setUniformItemSizes(True)
         self.templateView.setSpacing(50)
         self.templateView.setSelectionMode(QListView.SingleSelection)
@@ -442,6 +481,27 @@ class QtPyPhotobooth(QObject):
         self.templateView.clicked.connect(lambda index: self.onTemplateSelected(index))
         self.templateView.setModel(self.templateModel)
 
+    #-----------------------------------------------------------#
+    def __getTemplateIcon(self, template):
+        """Return the icon for a template. Icons are cached by image path so each image is only converted once
+        and every template without a preview shares the default icon."""
+        previewPath = template.getTemplatePreviewPath()
+        thumbnail = template.getPreviewThumbnail()
+        if(thumbnail is None):
+            previewPath = self.resourcePath + os.path.sep + self.defaultTemplateIcon
+
+        icon = self.templateIcons.get(previewPath)
+        if(icon is None):
+            #Previews are decoded at icon size when the templates are loaded
+            if(thumbnail is not None):
+                pixmap = self.__pixmapFromImage(thumbnail)
+            else:
+                #Scale the default icon once here rather than have the view scale it every time it paints
+                pixmap = QPixmap(previewPath).scaled(QSize(*self.templateIconSize), Qt.KeepAspectRatio, Qt.SmoothTransformation)
+            icon = QIcon(pixmap)
+            self.templateIcons[previewPath] = icon
+        return icon
+
     #---------------------------------------------------------#
     def onPhotosTaken(self, photoList):
         #Move to the processing page.
@@ -468,17 +528,12 @@ class QtPyPhotobooth(QObject):
         self.camera.start_preview()
         thread = threading.Thread(target=self.camera.capturePhotos, args=(requestedPhotos, self.onPhotosTaken))
         thread.start()
+        from PhotoboothTemplate import ImageProcessor
         self.processor = ImageProcessor(self.selectedTemplate)
 
     #---------------------------------------------------------#
     def configureResultScreen(self):
         """Place the result image on the result screen."""
-        #take the image in question
-        imgQt = ImageQt.ImageQt(self.resultImage)
-        pixmap = QPixmap.fromImage(imgQt)
-        #detatch is required to keep a reference to the image as the imgQt object goes out of scope
-        pixmap.detach()
-
         ######################################
         #Figure out sizing and placement of the label.
         #update main window ui to remove scaled component.
@@ -486,7 +541,34 @@ class QtPyPhotobooth(QObject):
         print("Width: " + str(w))
         h = self.resultLabel.height()
         print("Height: " + str(h))
-        self.resultLabel.setPixmap(pixmap.scaled(w, h, Qt.KeepAspectRatio))
+
+        #Shrink the image to the label size before converting it so the full size result never becomes a pixmap
+        from PIL import Image
+        preview = self.resultImage.copy()
+        preview.thumbnail((w, h), Image.LANCZOS)
+        pixmap = self.__pixmapFromImage(preview)
+        #Small results are still scaled up to fill the label
+        if(pixmap.width() < w and pixmap.height() < h):
+            pixmap = pixmap.scaled(w, h, Qt.KeepAspectRatio)
+        self.resultLabel.setPixmap(pixmap)
+
+    #-----------------------------------------------------------------------#
+    def __pixmapFromImage(self, image):
+        """Convert a PIL image to a QPixmap by wrapping its RGB or RGBA bytes in a QImage. Transparency is kept.
+        fromImage copies the pixels, so the bytes only need to live until it returns."""
+        if(('A' in image.getbands()) or ('transparency' in image.info)):
+            if(image.mode != "RGBA"):
+                image = image.convert("RGBA")
+            qFormat = QImage.Format_RGBA8888
+            bytesPerPixel = 4
+        else:
+            if(image.mode != "RGB"):
+                image = image.convert("RGB")
+            qFormat = QImage.Format_RGB888
+            bytesPerPixel = 3
+        data = image.tobytes()
+        qImage = QImage(data, image.width, image.height, image.width * bytesPerPixel, qFormat)
+        return QPixmap.fromImage(qImage)
 
     #-----------------------------------------------------------------------#
     def onCancelButtonClicked(self):
@@ -497,20 +579,39 @@ class QtPyPhotobooth(QObject):
     def onSaveButtonClicked(self):
         """Handle the action of saving or sending the photo through a specific delivery mechanism."""
         self.__changeScreens(QtPyPhotobooth.Screens.SAVING)
+        self.saveList = list()
+        if(len(self.deliveryList) == 0):
+            self.onPhotoSaved()
+            return
         
-        thread = threading.Thread(target=self.savePhoto, args=(self.onPhotoSaved,))
+        thread = threading.Thread(target=self.savePhoto)
         thread.start()
 
     #-----------------------------------------------------------------------#
-    def savePhoto(self, callback):
-        """Process all the save methods"""
-        
-        for method in self.deliveryList:
-            print("Saving to " + method.getServiceName())
-            method.photoSaveUpdate.connect(self.updateHandler)
-            method.photoSaveComplete.connect(self.completeHandler)
-            method.saveImage(self.resultImage)
-        callback()
+    def __addDeliveryMethod(self, method):
+        """Add a delivery method to the list and connect its signals. This is only done once per method."""
+        method.photoSaveUpdate.connect(self.updateHandler)
+        method.photoSaveComplete.connect(self.completeHandler)
+        self.deliveryList.append(method)
+
+    #-----------------------------------------------------------------------#
+    def savePhoto(self):
+        """Process all the save methods. The saved screen is shown once every method has sent photoSaveComplete."""
+        #The delivery methods don't depend on each other, so they all save at the same time
+        #and the save is finished when the slowest one is done.
+        with ThreadPoolExecutor(max_workers=len(self.deliveryList)) as executor:
+            for method in self.deliveryList:
+                print("Saving to " + method.getServiceName())
+                future = executor.submit(method.saveImage, self.resultImage)
+                future.add_done_callback(functools.partial(self.__onSaveTaskDone, method))
+
+    #-----------------------------------------------------------------------#
+    def __onSaveTaskDone(self, method, future):
+        """Print errors from a delivery method so one failing method doesn't stop the others.
+        A method that raised won't report its own result, so it is reported as failed here."""
+        if(future.exception() is not None):
+            print("Error saving photo: " + repr(future.exception()))
+            method.photoSaveComplete.emit(method.getServiceName(), False)
 
     #-----------------------------------------------------------------------#
     def updateHandler(self, serviceName, total, progress):
@@ -522,15 +623,22 @@ class QtPyPhotobooth(QObject):
         """ Allows the delivery method to indicate that it has completed saving/uploading the photo"""
         print("Save to " + serviceName + " " + ("successful." if success else  "failed."))
         self.saveList.append((serviceName, success))
+        #Saving is finished once every delivery method has reported
+        if(len(self.saveList) == len(self.deliveryList)):
+            self.onPhotoSaved()
+
+    #-----------------------------------------------------------------------#
+    def shutdown(self):
+        """Let the delivery methods finish any saves that are still queued before the program exits."""
+        for method in self.deliveryList:
+            method.close()
 
     #-----------------------------------------------------------------------#
     def onPhotoSaved(self):
         """Update the gui to indicate that the photo has been saved."""
         self.__changeScreens(QtPyPhotobooth.Screens.SAVED)
-         #Show the saved screen for a specific amount of time before moving on.
-         #We are using time because this is run in a separate thread from the ui thread.
-        time.sleep(self.splashTime/1000)
-        self.__changeScreens(QtPyPhotobooth.Screens.TEMPLATE)
+        #Show the saved screen for a specific amount of time before moving on.
+        QTimer.singleShot(self.splashTime, lambda: self.__changeScreens(QtPyPhotobooth.Screens.TEMPLATE))
 
 ####################################################################################
 # QBasicListSelector                                                               #
@@ -586,4 +694,5 @@ if(__name__ == '__main__'):
 
     app = QApplication(sys.argv)
     mApplication = QtPyPhotobooth()
+    app.aboutToQuit.connect(mApplication.shutdown)
     sys.exit(app.exec_())
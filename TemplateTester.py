@@ -13,7 +13,10 @@ def generateSampleImage(imageName, width, height):
     img = Image.new("RGB", (width, height), "gray")
     draw = ImageDraw.Draw(img)
     text = imageName + "\n" + str(width) + "x" + str(height)
-    textSize = draw.textsize(text)
+    if(hasattr(draw, "textbbox")):
+        textSize = draw.textbbox((0, 0), text)[2:]
+    else:
+        textSize = draw.textsize(text)
     draw.text(((width-textSize[0])/2,(height-textSize[1])/2), str(text))
     return img
 